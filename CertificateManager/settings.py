@@ -57,6 +57,11 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+CRONJOBS = [
+    ('* * * * *', 'api.cron.run_export_jobs'),
+    ('*/5 * * * *', 'api.cron.run_recognition'),
+]
+
 ROOT_URLCONF = 'CertificateManager.urls'
 
 TEMPLATES = [
@@ -109,6 +114,16 @@ DATABASES = {
 }
 
 
+# Cache
+# 未配置时使用进程内缓存。多进程部署时应在config.CACHE中配置共享的缓存，格式同CACHES['default']
+
+CACHES = {
+    'default': getattr(config, 'CACHE', None) or {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -151,3 +166,9 @@ STATICFILES_DIRS = [
 STATIC_URL = '/%sstatic/' % (config.URL_PREFIX,)
 TEMP_DIRS = os.path.join(BASE_DIR, 'tmp')
 IMAGE_DIRS = os.path.join(BASE_DIR, 'static/' + config.IMAGE_STORAGE['FILEPATH'])
+# 图片经过权限检查后由api/files/images发送，不应再作为静态文件直接公开
+IMAGE_URL = '/%sapi/files/images/' % (config.URL_PREFIX,)
+# 交给前端代理发送文件的方式：None（由django发送）、'nginx'（X-Accel-Redirect）或'apache'（X-Sendfile）
+IMAGE_SENDFILE = config.IMAGE_STORAGE.get('SENDFILE', None)
+# nginx中对应IMAGE_DIRS的internal location
+IMAGE_INTERNAL_URL = '%s%s/' % (STATIC_URL, config.IMAGE_STORAGE['FILEPATH'])
@@ -1,6 +1,8 @@
 from django.apps import AppConfig
+from django.core.signals import request_finished
 from django.db.models.signals import post_migrate
 from . import enums
+import atexit
 
 
 def check_initial_user():
@@ -21,8 +23,36 @@ def check_initial_user():
         print('Skipped')
 
 
-def callback(sender, **kwarg):
+def check_record_summary():
+    from . import models as app_models, services
+    print('Checking record summary... ', end='')
+    missing = app_models.AwardRecord.objects.filter(summary__isnull=True).values_list('id', flat=True)
+    if missing.exists():
+        print('Missing. Rebuilding record summary...')
+        services.Summary.refresh(list(missing))
+    else:
+        print('Done')
+
+
+def is_fully_migrated(using):
+    from django.db import connections
+    from django.db.migrations.executor import MigrationExecutor
+    executor = MigrationExecutor(connections[using])
+    return not executor.migration_plan(executor.loader.graph.leaf_nodes())
+
+
+def callback(sender, using='default', **kwarg):
+    # 只迁移到部分版本（例如回滚）时，检查用到的表和列可能还不存在
+    if not is_fully_migrated(using):
+        print('Partially migrated. Skipped checking initial user and record summary.')
+        return
     check_initial_user()
+    check_record_summary()
+
+
+def flush_last_seen(sender=None, **kwargs):
+    from . import services
+    services.LastSeen.flush(force=sender is None)
 
 
 class ApiConfig(AppConfig):
@@ -30,3 +60,7 @@ class ApiConfig(AppConfig):
 
     def ready(self):
         post_migrate.connect(callback, sender=self)
+        from . import signals
+        signals.connect()
+        request_finished.connect(flush_last_seen)
+        atexit.register(flush_last_seen)
@@ -0,0 +1,84 @@
+from django.db.models import F
+from . import models as app_models
+import threading
+import time
+
+
+class Version:
+    # 保存在DataVersion表中的跨进程版本号。各数据表的版本以model_name命名
+
+    @staticmethod
+    def get(name):
+        version = app_models.DataVersion.objects.filter(name=name).values_list('version', flat=True).first()
+        return version if version is not None else 0
+
+    @staticmethod
+    def get_many(names):
+        versions = dict(app_models.DataVersion.objects.filter(name__in=names).values_list('name', 'version'))
+        return tuple(versions.get(name, 0) for name in names)
+
+    @staticmethod
+    def bump(*names):
+        for name in names:
+            if app_models.DataVersion.objects.filter(name=name).update(version=F('version') + 1) == 0:
+                app_models.DataVersion.objects.get_or_create(name=name, defaults={'version': 1})
+
+    @staticmethod
+    def next(name):
+        # 递增并返回新的版本号。递增时取得的行锁保持到事务提交，因此各事务得到的版本号的大小顺序与提交顺序一致
+        Version.bump(name)
+        return Version.get(name)
+
+
+class ReferenceCache:
+    # RatingInfo与Competition的进程内缓存。两张表都很小且只由管理员修改，整表载入，按版本号失效
+    VERSION_NAME = 'reference'
+    CHECK_INTERVAL = 5          # seconds，两次检查版本号的最小间隔，也是其他进程的修改最长的可见延迟
+
+    _lock = threading.Lock()
+    _version = None
+    _checked = 0
+    _ratings = {}               # RatingInfo.competition_name -> RatingInfo
+    _competitions = {}          # Competition.name -> rating_info_id
+
+    @staticmethod
+    def load(force=False):
+        now = time.monotonic()
+        if not force and ReferenceCache._version is not None and \
+                now - ReferenceCache._checked < ReferenceCache.CHECK_INTERVAL:
+            return
+        with ReferenceCache._lock:
+            version = Version.get(ReferenceCache.VERSION_NAME)
+            if version != ReferenceCache._version:
+                ReferenceCache._ratings = {rating.competition_name: rating
+                                           for rating in app_models.RatingInfo.objects.all()}
+                ReferenceCache._competitions = dict(app_models.Competition.objects.values_list('name', 'rating_info_id'))
+                ReferenceCache._version = version
+            ReferenceCache._checked = now
+
+    @staticmethod
+    def invalidate():
+        # 在写入RatingInfo/Competition的同一事务中调用
+        Version.bump(ReferenceCache.VERSION_NAME)
+        with ReferenceCache._lock:
+            ReferenceCache._version = None
+
+    @staticmethod
+    def rating(rating_id):
+        ReferenceCache.load()
+        if rating_id not in ReferenceCache._ratings:
+            ReferenceCache.load(force=True)
+        return ReferenceCache._ratings.get(rating_id, None)
+
+    @staticmethod
+    def competition_names():
+        ReferenceCache.load()
+        return ReferenceCache._competitions.keys()
+
+    @staticmethod
+    def competition_rating(competition_name):
+        ReferenceCache.load()
+        if competition_name not in ReferenceCache._competitions:
+            ReferenceCache.load(force=True)
+        rating_id = ReferenceCache._competitions.get(competition_name, None)
+        return ReferenceCache._ratings.get(rating_id, None) if rating_id is not None else None
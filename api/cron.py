@@ -0,0 +1,16 @@
+from . import services, recognition
+
+
+def run_export_jobs():
+    services.Export.recover_stale()
+    services.Export.clean_expired()
+    services.Delta.clean_expired()
+    services.Export.run_pending()
+
+
+def run_recognition():
+    backend = recognition.get_backend()
+    if backend is None:
+        # 没有配置识别后端时不运行，图片保持未识别状态，配置后再处理
+        return
+    recognition.Worker(backend).run_pending()
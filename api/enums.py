@@ -17,6 +17,25 @@ REVIEW_STATUS = (
     ('NOT_PASS', 'NotPass')
 )
 
+EXPORT_STATUS = (
+    ('WAITING', 'Waiting'),
+    ('RUNNING', 'Running'),
+    ('FINISHED', 'Finished'),
+    ('FAILED', 'Failed')
+)
+
+EXPORT_PARTITION = (
+    ('COLLEGE', 'College'),
+    ('ID', 'Id')
+)
+
+RECOGNITION_STATUS = (
+    ('WAITING', 'Waiting'),
+    ('RUNNING', 'Running'),
+    ('FINISHED', 'Finished'),
+    ('FAILED', 'Failed')
+)
+
 
 class UserType:
     admin = 'ADMIN'
@@ -34,3 +53,22 @@ class ReviewStatus:
     waiting = 'WAITING'
     passed = 'PASSED'
     not_pass = 'NOT_PASS'
+
+
+class ExportStatus:
+    waiting = 'WAITING'
+    running = 'RUNNING'
+    finished = 'FINISHED'
+    failed = 'FAILED'
+
+
+class ExportPartition:
+    college = 'COLLEGE'
+    id = 'ID'
+
+
+class RecognitionStatus:
+    waiting = 'WAITING'
+    running = 'RUNNING'
+    finished = 'FINISHED'
+    failed = 'FAILED'
@@ -1,9 +1,15 @@
 import django_filters
+from django_filters.utils import translate_validation
+from rest_framework.filters import SearchFilter
 from . import models as app_models
 
+# 组成RecordSummary.search_document的字段
+RECORD_SEARCH_FIELDS = ('works_name', 'award_level', 'competition_record__name', 'teacher__name', 'students__name',
+                        'main_student__name')
+
 
 class Record(django_filters.FilterSet):
-    review__status = django_filters.CharFilter(field_name='review__status', lookup_expr='iexact')
+    review__status = django_filters.CharFilter(method='filter_review_status')
     update_time__gte = django_filters.DateTimeFilter(field_name='update_time', lookup_expr='gte')
     update_time__lte = django_filters.DateTimeFilter(field_name='update_time', lookup_expr='lte')
 
@@ -11,6 +17,90 @@ class Record(django_filters.FilterSet):
         model = app_models.AwardRecord
         fields = ('update_time__gte', 'update_time__lte', 'review__status')
 
+    @staticmethod
+    def filter_review_status(queryset, name, value):
+        # 状态值均为大写。转换后精确匹配，使查询能够命中review上的索引
+        return queryset.filter(review__status=value.upper())
+
+
+class RecordSummary(django_filters.FilterSet):
+    # 参数与Record相同，作用在RecordSummary上
+    review__status = django_filters.CharFilter(method='filter_review_status')
+    update_time__gte = django_filters.DateTimeFilter(field_name='update_time', lookup_expr='gte')
+    update_time__lte = django_filters.DateTimeFilter(field_name='update_time', lookup_expr='lte')
+
+    class Meta:
+        model = app_models.RecordSummary
+        fields = ('update_time__gte', 'update_time__lte', 'review__status')
+
+    @staticmethod
+    def filter_review_status(queryset, name, value):
+        return queryset.filter(review_status=value.upper())
+
+    PARAMS = ('update_time__gte', 'update_time__lte', 'review__status', 'search')
+
+    @staticmethod
+    def filter_records(queryset, params):
+        # 在请求之外（例如后台导出任务）复现Admin.Record的筛选与搜索
+        filterset = RecordSummary(params, queryset)
+        if not filterset.is_valid():
+            raise translate_validation(filterset.errors)
+        return RecordSummary.search(filterset.qs, params.get('search', '').replace(',', ' ').split())
+
+    @staticmethod
+    def get_params(query):
+        return {k: query[k] for k in RecordSummary.PARAMS if query.get(k, None) not in (None, '')}
+
+    @staticmethod
+    def normalize(params):
+        # 得到相同结果的参数规范化为相同的形式：时间统一为ISO格式，状态大写，搜索词小写、去重、排序
+        filterset = RecordSummary(params, app_models.RecordSummary.objects.none())
+        if not filterset.is_valid():
+            raise translate_validation(filterset.errors)
+        data = filterset.form.cleaned_data
+        normalized = {}
+        for name in ('update_time__gte', 'update_time__lte'):
+            if data.get(name, None) is not None:
+                normalized[name] = data[name].isoformat()
+        if data.get('review__status', None):
+            normalized['review__status'] = data['review__status'].upper()
+        terms = sorted({term.lower() for term in params.get('search', '').replace(',', ' ').split()})
+        if len(terms) > 0:
+            normalized['search'] = terms
+        return normalized
+
+    @staticmethod
+    def get_grams(document):
+        # search_grams的内容：每一行中的单字与相邻两字。两个字以内的中文人名产生不了pg_trgm的三元组，
+        # C locale下中文字符也不被pg_trgm视为单词字符，这两种情况只能依靠它上面的GIN索引
+        grams = set()
+        for line in document.split('\n'):
+            grams.update(line)
+            grams.update(line[i:i + 2] for i in range(len(line) - 1))
+        return sorted(grams)
+
+    @staticmethod
+    def search(queryset, terms):
+        # search_document已经是小写。search_grams包含搜索词的全部单字或相邻两字是必要条件，可以使用数组的GIN索引；
+        # 不超过两个字的搜索词这一条件已经精确，更长的仍需LIKE '%term%'确认，长词在pg_trgm可用时也可以使用三元组索引
+        for term in terms:
+            term = term.lower()
+            grams = [term] if len(term) <= 2 else [term[i:i + 2] for i in range(len(term) - 1)]
+            queryset = queryset.filter(search_grams__contains=sorted(set(grams)))
+            if len(term) > 2:
+                queryset = queryset.filter(search_document__contains=term)
+        return queryset
+
+
+class RecordSearchFilter(SearchFilter):
+    # 与SearchFilter的参数和语义相同，但只匹配RecordSummary.search_document，不再需要多表join与distinct
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if queryset.model is not app_models.RecordSummary:
+            return queryset.filter(summary__in=RecordSummary.search(app_models.RecordSummary.objects.all(), terms)) \
+                if len(terms) > 0 else queryset
+        return RecordSummary.search(queryset, terms)
+
 
 class User(django_filters.FilterSet):
     is_staff = django_filters.BooleanFilter(field_name='is_staff', lookup_expr='exact')
@@ -0,0 +1,206 @@
+from PIL import Image as PILImage
+from CertificateManager.settings import IMAGE_DIRS, IMAGE_URL
+from urllib.parse import quote
+import logging
+import numpy
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+class Derivative:
+    # 由原图生成的缩略图与预览图，保存在IMAGE_DIRS/derivatives，以原文件名与规格命名。
+    # 原文件按内容命名且不会被覆盖，因此派生图一经生成就不会过期
+    DERIVATIVE_DIRS = os.path.join(IMAGE_DIRS, 'derivatives')
+    VARIANTS = {
+        'thumbnail': (320, 320, 70),    # 最大宽度，最大高度，JPEG质量
+        'preview': (1600, 1600, 82)
+    }
+    # EXIF Orientation -> 需要的变换。手机照片通常只在EXIF中记录方向
+    ORIENTATION = {
+        2: (PILImage.FLIP_LEFT_RIGHT,),
+        3: (PILImage.ROTATE_180,),
+        4: (PILImage.FLIP_TOP_BOTTOM,),
+        5: (PILImage.ROTATE_90, PILImage.FLIP_TOP_BOTTOM),
+        6: (PILImage.ROTATE_270,),
+        7: (PILImage.ROTATE_270, PILImage.FLIP_TOP_BOTTOM),
+        8: (PILImage.ROTATE_90,)
+    }
+    EXIF_ORIENTATION = 0x0112
+
+    @staticmethod
+    def get_name(name, variant):
+        return '%s.%s.jpg' % (name, variant)
+
+    @staticmethod
+    def get_path(name, variant):
+        return os.path.join(Derivative.DERIVATIVE_DIRS, Derivative.get_name(name, variant))
+
+    @staticmethod
+    def get_url(name, variant=None):
+        url = '%s%s/' % (IMAGE_URL, quote(name))
+        return '%s?variant=%s' % (url, variant) if variant is not None else url
+
+    @staticmethod
+    def transpose(image):
+        exif = image._getexif() if hasattr(image, '_getexif') else None
+        orientation = exif.get(Derivative.EXIF_ORIENTATION, None) if exif is not None else None
+        for method in Derivative.ORIENTATION.get(orientation, ()):
+            image = image.transpose(method)
+        return image
+
+    @staticmethod
+    def write(image, path, quality):
+        # 先写入同目录下的临时文件，完成后原子地rename
+        if not os.path.exists(Derivative.DERIVATIVE_DIRS):
+            os.makedirs(Derivative.DERIVATIVE_DIRS, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=Derivative.DERIVATIVE_DIRS, prefix='.derivative-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, 'JPEG', quality=quality, optimize=True, progressive=True)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def generate(name, variant):
+        path = Derivative.get_path(name, variant)
+        if os.path.exists(path):
+            return path
+        width, height, quality = Derivative.VARIANTS[variant]
+        with PILImage.open(os.path.join(IMAGE_DIRS, name)) as source:
+            # JPEG可以在解码时直接降采样，大图不必完整解码
+            source.draft('RGB', (width, height))
+            image = Derivative.transpose(source)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.thumbnail((width, height), PILImage.LANCZOS)
+            Derivative.write(image, path, quality)
+        return path
+
+    @staticmethod
+    def ensure(name):
+        # 生成全部规格。原文件不是可识别的图片时只记录日志，客户端仍可使用原图
+        for variant in Derivative.VARIANTS.keys():
+            try:
+                Derivative.generate(name, variant)
+            except (IOError, OSError, ValueError) as e:
+                logger.warning('Cannot generate %s of image %s: %s', variant, name, e)
+                return False
+        return True
+
+    @staticmethod
+    def remove(name):
+        for variant in Derivative.VARIANTS.keys():
+            path = Derivative.get_path(name, variant)
+            if os.path.exists(path):
+                os.remove(path)
+        path = Derivative.get_path(name, Preprocess.VARIANT)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class Preprocess:
+    # 识别前的预处理：降采样、灰度化、纠正倾斜、裁剪到证书区域、拉伸对比度。
+    # 结果与缩略图一样以原文件名命名，缓存在IMAGE_DIRS/derivatives中
+    VARIANT = 'ocr'
+    TARGET_DPI = 200
+    PAGE_INCHES = 11.7              # 证书按A4纸估计，长边约11.7英寸
+    QUALITY = 90
+    SKEW_ANGLES = numpy.arange(-10, 10.25, 0.25)    # 检测的倾斜角度，单位为度
+    SKEW_SIZE = 800                 # 检测倾斜时使用的图像长边
+    SKEW_POINTS = 20000             # 检测倾斜时最多采样的暗像素数
+    CROP_MIN_AREA = 0.3             # 检测到的证书区域小于该比例时认为检测失败，不裁剪
+    CONTRAST_PERCENTILES = (1, 99)
+
+    @staticmethod
+    def get_path(name):
+        return Derivative.get_path(name, Preprocess.VARIANT)
+
+    @staticmethod
+    def ensure(name):
+        # 返回预处理后的文件路径；原图无法处理时返回原图路径
+        path = Preprocess.get_path(name)
+        if os.path.exists(path):
+            return path
+        try:
+            with PILImage.open(os.path.join(IMAGE_DIRS, name)) as source:
+                Derivative.write(Preprocess.process(source), path, Preprocess.QUALITY)
+            return path
+        except (IOError, OSError, ValueError) as e:
+            logger.warning('Cannot preprocess image %s: %s', name, e)
+            return os.path.join(IMAGE_DIRS, name)
+
+    @staticmethod
+    def process(source):
+        size = int(Preprocess.TARGET_DPI * Preprocess.PAGE_INCHES)
+        source.draft('L', (size, size))
+        image = Derivative.transpose(source).convert('L')
+        image.thumbnail((size, size), PILImage.LANCZOS)
+        angle = Preprocess.detect_skew(image)
+        if angle != 0:
+            # rotate按逆时针旋转，反向旋转检测到的角度。空出的角落填充为暗色，随后作为背景被裁剪掉
+            image = image.rotate(-angle, resample=PILImage.BICUBIC, expand=True, fillcolor=0)
+        array = numpy.asarray(image, dtype=numpy.uint8)
+        array = Preprocess.crop(array)
+        array = Preprocess.stretch(array)
+        return PILImage.fromarray(array, 'L')
+
+    @staticmethod
+    def otsu(array):
+        # 最大类间方差阈值
+        histogram = numpy.bincount(array.ravel(), minlength=256).astype(numpy.float64)
+        weight = numpy.cumsum(histogram)
+        mean = numpy.cumsum(histogram * numpy.arange(256))
+        total_weight, total_mean = weight[-1], mean[-1]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            variance = (total_mean * weight - mean * total_weight) ** 2 / (weight * (total_weight - weight))
+        # 单一灰度的图像没有有效的阈值，此时返回0
+        return int(numpy.argmax(numpy.nan_to_num(variance)))
+
+    @staticmethod
+    def detect_skew(image):
+        # 返回图像相对水平逆时针倾斜的角度。投影法：文字行与投影方向平行时，暗像素在各行上的分布最集中。所有候选角度在一次矩阵运算中同时计算
+        small = image.copy()
+        small.thumbnail((Preprocess.SKEW_SIZE, Preprocess.SKEW_SIZE))
+        array = numpy.asarray(small, dtype=numpy.uint8)
+        ys, xs = numpy.nonzero(array < Preprocess.otsu(array))
+        if len(ys) < 100:
+            return 0
+        if len(ys) > Preprocess.SKEW_POINTS:
+            index = numpy.random.RandomState(0).choice(len(ys), Preprocess.SKEW_POINTS, replace=False)
+            ys, xs = ys[index], xs[index]
+        radians = numpy.deg2rad(Preprocess.SKEW_ANGLES)
+        # 将点旋转-angle后的纵坐标，shape为(角度数, 点数)
+        projected = numpy.outer(numpy.cos(radians), ys) + numpy.outer(numpy.sin(radians), xs)
+        projected = numpy.rint(projected - projected.min()).astype(numpy.int64)
+        bins = int(projected.max()) + 1
+        offsets = (numpy.arange(len(radians)) * bins)[:, None]
+        profiles = numpy.bincount((projected + offsets).ravel(), minlength=len(radians) * bins) \
+            .reshape(len(radians), bins).astype(numpy.float64)
+        scores = (numpy.diff(profiles, axis=1) ** 2).sum(axis=1)
+        return float(Preprocess.SKEW_ANGLES[int(numpy.argmax(scores))])
+
+    @staticmethod
+    def crop(array):
+        # 证书纸张比背景亮：取亮像素占多数的行与列的范围
+        mask = array >= Preprocess.otsu(array)
+        rows = numpy.nonzero(mask.mean(axis=1) > 0.5)[0]
+        cols = numpy.nonzero(mask.mean(axis=0) > 0.5)[0]
+        if len(rows) == 0 or len(cols) == 0:
+            return array
+        top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        if (bottom - top) * (right - left) < Preprocess.CROP_MIN_AREA * array.size:
+            return array
+        return array[top:bottom, left:right]
+
+    @staticmethod
+    def stretch(array):
+        low, high = numpy.percentile(array, Preprocess.CONTRAST_PERCENTILES)
+        if high - low < 1:
+            return array
+        stretched = (array.astype(numpy.float32) - low) * (255.0 / (high - low))
+        return numpy.clip(stretched, 0, 255).astype(numpy.uint8)
@@ -0,0 +1,89 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from api import models as app_models, services, enums
+from CertificateManager.settings import IMAGE_DIRS
+import os
+import shutil
+import time
+import uuid
+
+
+class Command(BaseCommand):
+    help = 'Seed records with fresh image files in a rolled back transaction and time the export archive ' \
+           'with a cold page cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=10000, help='Number of image files to export.')
+        parser.add_argument('--size', type=int, default=300 * 1024, help='Size of each image file in bytes.')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, services.Download.PREFETCH_WORKERS],
+                            help='Prefetch thread counts to compare.')
+
+    def handle(self, *args, **options):
+        # 图片写在IMAGE_DIRS下的临时子目录中，get_image_list只接受相对于IMAGE_DIRS的文件名
+        directory = 'benchmark-%s' % (uuid.uuid4().hex,)
+        default_workers = services.Download.PREFETCH_WORKERS
+        results = []
+        try:
+            paths = self.seed_files(directory, options['images'], options['size'])
+            with transaction.atomic():
+                queryset = self.seed_records(directory, options['images'])
+                for workers in options['workers']:
+                    method = self.drop_cache(paths)
+                    services.Download.PREFETCH_WORKERS = workers
+                    start = time.perf_counter()
+                    total = sum(len(chunk) for chunk in services.Download.iter_zip(queryset))
+                    results.append((workers, method, time.perf_counter() - start, total))
+                transaction.set_rollback(True)
+        finally:
+            services.Download.PREFETCH_WORKERS = default_workers
+            shutil.rmtree(os.path.join(IMAGE_DIRS, directory), ignore_errors=True)
+        self.stdout.write('images: %s, %s bytes each' % (options['images'], options['size']))
+        self.stdout.write('%-8s %-14s %-10s %-10s %-10s' % ('workers', 'cold cache', 'seconds', 'MB/s', 'files/s'))
+        for (workers, method, seconds, total) in results:
+            self.stdout.write('%-8s %-14s %-10.2f %-10.1f %-10.0f' % (workers, method, seconds,
+                                                                      total / seconds / 1024 / 1024,
+                                                                      options['images'] / seconds))
+
+    def seed_files(self, directory, count, size):
+        self.stdout.write('Writing %s image files...' % (count,))
+        os.makedirs(os.path.join(IMAGE_DIRS, directory))
+        paths = []
+        for i in range(count):
+            path = os.path.join(IMAGE_DIRS, directory, '%s.jpg' % (i,))
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            paths.append(path)
+        os.sync()
+        return paths
+
+    def seed_records(self, directory, count):
+        now = timezone.now()
+        records = app_models.AwardRecord.objects.bulk_create(
+            [app_models.AwardRecord(works_name='bench %s' % (i,), award_level='一等奖', update_time=now)
+             for i in range(count)], batch_size=services.Batch.BULK_SIZE)
+        app_models.RecordSummary.objects.bulk_create(
+            [app_models.RecordSummary(award_record_id=record.id, works_name=record.works_name,
+                                      award_level=record.award_level, update_time=now, refresh_time=now,
+                                      images=[{'category': enums.ImageCategory.award,
+                                               'file': '%s/%s.jpg' % (directory, i)}])
+             for (i, record) in enumerate(records)], batch_size=services.Batch.BULK_SIZE)
+        return app_models.RecordSummary.objects.filter(award_record_id__in=[record.id for record in records]) \
+            .order_by('award_record_id')
+
+    @staticmethod
+    def drop_cache(paths):
+        # 有权限时清空整个页缓存，否则逐个文件丢弃缓存的页。文件已经写回磁盘，缓存的页都是干净的
+        try:
+            with open('/proc/sys/vm/drop_caches', 'w') as f:
+                f.write('1')
+            return 'drop_caches'
+        except OSError:
+            pass
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        return 'fadvise'
@@ -0,0 +1,106 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from api import models as app_models, enums
+import datetime
+import re
+
+
+class Command(BaseCommand):
+    help = 'Seed records in a rolled back transaction and compare query plans with and without the record indexes.'
+
+    # 需要比较的索引，见migrations/0006；Image上的索引后来被唯一约束取代
+    INDEXES = ('award_submit_user_update_idx', 'award_update_time_idx', 'competition_record_name_idx',
+               'review_status_idx', 'review_waiting_idx')
+    CONSTRAINTS = ((app_models.Image, 'image_record_category_unique'),)
+    USER_RECORDS = 20                   # 作为被查询学生提交的记录数
+    WAITING_RATIO = 50                  # 每多少条记录中有一条待审核
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=500000, help='Number of award records to seed.')
+        parser.add_argument('--i-know-this-locks-tables', action='store_true', dest='locks_tables',
+                            help='Allow running outside DEBUG. Dropping the indexes holds ACCESS EXCLUSIVE locks on '
+                                 'the record tables until the transaction rolls back.')
+
+    def handle(self, *args, **options):
+        # DROP INDEX在回滚前一直持有表的排他锁，生产库上会阻塞所有读写
+        if not settings.DEBUG and not options['locks_tables']:
+            raise CommandError('This command locks the record tables for the whole run. '
+                               'Run it with DEBUG or pass --i-know-this-locks-tables.')
+        with transaction.atomic():
+            first_id, user_id = self.seed(options['records'])
+            queries = self.get_queries(first_id, user_id)
+            after = [self.explain(queryset) for (_, queryset) in queries]
+            self.drop_indexes()
+            before = [self.explain(queryset) for (_, queryset) in queries]
+            transaction.set_rollback(True)
+        self.stdout.write('%-20s %-44s %-44s' % ('query', 'without indexes', 'with indexes'))
+        for ((name, _), b, a) in zip(queries, before, after):
+            self.stdout.write('%-20s %-44s %-44s' % (name, b, a))
+
+    def seed(self, count):
+        tables = {
+            'record': app_models.AwardRecord._meta.db_table,
+            'review': app_models.Review._meta.db_table,
+            'competition_record': app_models.CompetitionRecord._meta.db_table,
+            'image': app_models.Image._meta.db_table
+        }
+        user = app_models.User.objects.order_by('id').first()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT coalesce(max(id), 0) FROM {record}'.format(**tables))
+            first_id = cursor.fetchone()[0] + 1
+            self.stdout.write('Seeding %s records...' % (count,))
+            cursor.execute('INSERT INTO {record} (works_name, award_level, update_time, submit_user_id) '
+                           'SELECT \'bench \' || i, \'一等奖\', now() - make_interval(mins => i), '
+                           '       CASE WHEN i %% %s = 0 THEN %s END '
+                           'FROM generate_series(1, %s) i'.format(**tables),
+                           [max(1, count // self.USER_RECORDS), user.id if user is not None else None, count])
+            cursor.execute('INSERT INTO {review} (status, award_record_id) '
+                           'SELECT CASE WHEN id %% %s = 0 THEN %s ELSE %s END, id FROM {record} WHERE id >= %s'
+                           .format(**tables), [self.WAITING_RATIO, enums.ReviewStatus.waiting,
+                                               enums.ReviewStatus.passed, first_id])
+            cursor.execute('INSERT INTO {competition_record} (name, category, hold_time, organizer, award_record_id) '
+                           'SELECT \'bench competition \' || (id %% 5000), \'bench\', current_date, \'bench\', id '
+                           'FROM {record} WHERE id >= %s'.format(**tables), [first_id])
+            cursor.execute('INSERT INTO {image} (category, file, award_record_id) '
+                           'SELECT c.category, \'bench-\' || r.id || \'-\' || c.category || \'.jpg\', r.id '
+                           'FROM {record} r CROSS JOIN (VALUES (%s), (%s)) c(category) WHERE r.id >= %s'
+                           .format(**tables), [enums.ImageCategory.award, enums.ImageCategory.notice, first_id])
+            for table in tables.values():
+                cursor.execute('ANALYZE %s' % (table,))
+        return first_id, user.id if user is not None else None
+
+    def get_queries(self, first_id, user_id):
+        middle = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=30)
+        return (
+            ('student records', app_models.AwardRecord.objects.filter(submit_user_id=user_id)
+             .order_by('-update_time')[:20]),
+            ('waiting queue', app_models.AwardRecord.objects.filter(review__status=enums.ReviewStatus.waiting)
+             .order_by('-update_time')[:20]),
+            ('update time range', app_models.AwardRecord.objects
+             .filter(update_time__gte=middle - datetime.timedelta(hours=1), update_time__lte=middle)
+             .order_by('-update_time', '-id')[:20]),
+            ('image lookup', app_models.Image.objects.filter(award_record_id=first_id + 1000,
+                                                            category=enums.ImageCategory.award)),
+            ('competition name', app_models.CompetitionRecord.objects.filter(name='bench competition 42')[:20])
+        )
+
+    def drop_indexes(self):
+        with connection.cursor() as cursor:
+            # 延迟检查的外键约束必须先执行完，才能在同一事务中修改表
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            for name in self.INDEXES:
+                cursor.execute('DROP INDEX IF EXISTS %s' % (name,))
+            for (model, name) in self.CONSTRAINTS:
+                cursor.execute('ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s' % (model._meta.db_table, name))
+
+    @staticmethod
+    def explain(queryset):
+        # 返回计划中用到的扫描方式与实际执行时间
+        plan = queryset.explain(analyze=True)
+        scans = []
+        for match in re.finditer(r'((?:Parallel )?(?:Seq|Index Only|Index|Bitmap Heap|Bitmap Index)) Scan'
+                                 r'(?: using (\w+))?(?: on (\w+))?', plan):
+            scans.append('%s(%s)' % (match.group(1), match.group(2) or match.group(3)))
+        time = re.search(r'Execution Time: ([\d.]+) ms', plan)
+        return '%s ms %s' % (time.group(1) if time else '?', ', '.join(dict.fromkeys(scans)))
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image as PILImage, ImageDraw
+from api import images as app_images
+import os
+import random
+import tempfile
+import time
+
+
+class Command(BaseCommand):
+    help = 'Time the recognition preprocessing on synthetic certificate photos and check it against a budget.'
+
+    PAGE_SIZE = (2480, 3508)    # A4，300DPI
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=20, help='Number of synthetic photos.')
+        parser.add_argument('--width', type=int, default=3200, help='Width of the synthetic photos.')
+        parser.add_argument('--height', type=int, default=4200, help='Height of the synthetic photos.')
+        parser.add_argument('--budget', type=float, default=1.0, help='Allowed seconds per image at the 95th percentile.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rand = random.Random(options['seed'])
+        times, errors, input_bytes, output_bytes = [], [], 0, 0
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for i in range(options['images']):
+                skew = round(rand.uniform(-8, 8), 2)
+                path = os.path.join(temp_dir, '%s.jpg' % (i,))
+                self.generate(skew, options['width'], options['height'], rand).save(path, 'JPEG', quality=90)
+                input_bytes += os.path.getsize(path)
+                # 计时包括解码，与Preprocess.ensure中的处理相同
+                start = time.perf_counter()
+                with PILImage.open(path) as source:
+                    result = app_images.Preprocess.process(source)
+                times.append(time.perf_counter() - start)
+                errors.append(abs(app_images.Preprocess.detect_skew(result)))
+                output_path = os.path.join(temp_dir, '%s.ocr.jpg' % (i,))
+                result.save(output_path, 'JPEG', quality=app_images.Preprocess.QUALITY)
+                output_bytes += os.path.getsize(output_path)
+        times.sort()
+        p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+        self.stdout.write('images: %s, size: %sx%s' % (len(times), options['width'], options['height']))
+        self.stdout.write('seconds per image: median %.3f, p95 %.3f, max %.3f' % (times[len(times) // 2], p95, times[-1]))
+        self.stdout.write('residual skew: max %.2f degrees' % (max(errors),))
+        self.stdout.write('bytes per image: input %s, output %s' % (input_bytes // len(times), output_bytes // len(times)))
+        if p95 > options['budget']:
+            raise CommandError('p95 %.3fs exceeds the budget of %.3fs.' % (p95, options['budget']))
+
+    def generate(self, skew, width, height, rand):
+        # 浅色纸张上排列文字块，放在深色背景上并旋转skew度，模拟手机拍摄的证书
+        page = PILImage.new('RGB', self.PAGE_SIZE, (238, 232, 215))
+        draw = ImageDraw.Draw(page)
+        for y in range(300, self.PAGE_SIZE[1] - 300, 90):
+            x = 250
+            while x < self.PAGE_SIZE[0] - 300:
+                w = rand.randint(30, 60)
+                draw.rectangle([x, y, x + w, y + 30], fill=(40, 30, 30))
+                x += w + rand.randint(15, 40)
+        photo = PILImage.new('RGB', (width, height), (70, 60, 50))
+        photo.paste(page, ((width - self.PAGE_SIZE[0]) // 2, (height - self.PAGE_SIZE[1]) // 2))
+        return photo.rotate(skew, resample=PILImage.BICUBIC, fillcolor=(70, 60, 50))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from api import models as app_models, images as app_images
+
+
+class Command(BaseCommand):
+    help = 'Generate the missing thumbnail and preview derivatives of uploaded images.'
+
+    def handle(self, *args, **options):
+        names = app_models.Image.objects.order_by('file').values_list('file', flat=True).distinct()
+        total, failed = 0, 0
+        for name in names.iterator():
+            total += 1
+            if not app_images.Derivative.ensure(name):
+                failed += 1
+        self.stdout.write('images: %s, failed: %s' % (total, failed))
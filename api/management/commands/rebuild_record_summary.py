@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import services
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the record summary read model and report rows that had drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report drift, do not write anything.')
+
+    def handle(self, *args, **options):
+        missing, extra, drifted = services.Summary.rebuild(check=options['check'])
+        self.stdout.write('missing: %s, extra: %s, drifted: %s' % (len(missing), len(extra), len(drifted)))
+        for (name, ids) in (('missing', missing), ('extra', extra), ('drifted', drifted)):
+            if len(ids) > 0:
+                self.stdout.write('  %s: %s' % (name, ', '.join(str(i) for i in ids)))
+        if options['check'] and len(missing) + len(extra) + len(drifted) > 0:
+            raise CommandError('Record summary has drifted. Run rebuild_record_summary without --check to fix it.')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from api import services
+import time
+
+
+class Command(BaseCommand):
+    help = 'Build the archives of pending export jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new jobs instead of exiting.')
+        parser.add_argument('--interval', type=int, default=5, help='Seconds between two polls in loop mode.')
+
+    def handle(self, *args, **options):
+        services.Export.recover_stale()
+        while True:
+            services.Export.clean_expired()
+            services.Delta.clean_expired()
+            services.Export.run_pending()
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from api import recognition
+import time
+
+
+class Command(BaseCommand):
+    help = 'Recognize the uploaded images that have no recognition result yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', choices=sorted(recognition.BACKENDS.keys()), default=None,
+                            help='Recognizer backend. Defaults to config.RECOGNITION, or baidu if BAIDU_AIP is set.')
+        parser.add_argument('--workers', type=int, default=None, help='Size of the recognition thread pool.')
+        parser.add_argument('--batch-size', type=int, default=None, help='Images fetched from the database at a time.')
+        parser.add_argument('--retry-failed', action='store_true', help='Queue failed recognitions again.')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new images instead of exiting.')
+        parser.add_argument('--interval', type=int, default=30, help='Seconds between two polls in loop mode.')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            recognition.Worker.reset(retry_failed=True)
+        backend = recognition.get_backend(options['backend'])
+        if backend is None:
+            raise CommandError('No recognition backend is configured. Set BAIDU_AIP or RECOGNITION in config.py, '
+                               'or pass --backend stub for offline testing.')
+        while True:
+            worker = recognition.Worker(backend, workers=options['workers'], batch_size=options['batch_size'])
+            count = worker.run_pending()
+            self.stdout.write('%s images processed.' % (count,))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
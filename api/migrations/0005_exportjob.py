@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:26
+
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0004_awardrecord_main_student'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('WAITING', 'Waiting'), ('RUNNING', 'Running'), ('FINISHED', 'Finished'), ('FAILED', 'Failed')], default='WAITING', max_length=12)),
+                ('params', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('file', models.CharField(max_length=256, null=True)),
+                ('error', models.TextField(null=True)),
+                ('create_time', models.DateTimeField()),
+                ('finish_time', models.DateTimeField(null=True)),
+                ('create_user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='export_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='awardrecord',
+            index=models.Index(fields=['submit_user', '-update_time'], name='award_submit_user_update_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='awardrecord',
+            index=models.Index(fields=['-update_time', '-id'], name='award_update_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='competitionrecord',
+            index=models.Index(fields=['name'], name='competition_record_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['award_record', 'category'], name='image_record_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['status', 'award_record'], name='review_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(condition=models.Q(status='WAITING'), fields=['award_record'], name='review_waiting_idx'),
+        ),
+    ]
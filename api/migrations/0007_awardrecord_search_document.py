@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:32
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_auto_20261018_1631'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='awardrecord',
+            name='search_document',
+            field=models.TextField(default=''),
+        ),
+        migrations.AddIndex(
+            model_name='awardrecord',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_document'], name='award_search_document_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.RunSQL(
+            sql="UPDATE api_awardrecord a SET search_document = lower(concat_ws(E'\\n', a.works_name, a.award_level, "
+                "  (SELECT cr.name FROM api_competitionrecord cr WHERE cr.award_record_id = a.id), "
+                "  (SELECT t.name FROM api_teacher t WHERE t.id = a.teacher_id), "
+                "  (SELECT s.name FROM api_student s WHERE s.id = a.main_student_id), "
+                "  (SELECT string_agg(s.name, E'\\n' ORDER BY r.id) FROM api_awardstudentrelation r "
+                "   JOIN api_student s ON s.id = r.student_id WHERE r.award_id = a.id)))",
+            reverse_sql=migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:35
+
+import django.contrib.postgres.fields.jsonb
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_awardrecord_search_document'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordSummary',
+            fields=[
+                ('award_record', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='api.AwardRecord')),
+                ('works_name', models.CharField(max_length=128, null=True)),
+                ('award_level', models.CharField(max_length=16)),
+                ('update_time', models.DateTimeField()),
+                ('review_status', models.CharField(choices=[('WAITING', 'Waiting'), ('PASSED', 'Passed'), ('NOT_PASS', 'NotPass')], max_length=12, null=True)),
+                ('competition_name', models.CharField(max_length=128, null=True)),
+                ('competition_category', models.CharField(max_length=128, null=True)),
+                ('hold_time', models.DateField(null=True)),
+                ('organizer', models.CharField(max_length=128, null=True)),
+                ('rating_category', models.CharField(max_length=16, null=True)),
+                ('rating_level_title', models.CharField(max_length=16, null=True)),
+                ('rating_level', models.IntegerField(null=True)),
+                ('teacher', models.CharField(max_length=32, null=True)),
+                ('teacher_info', django.contrib.postgres.fields.jsonb.JSONField(null=True)),
+                ('main_student', models.CharField(max_length=32, null=True)),
+                ('main_student_info', django.contrib.postgres.fields.jsonb.JSONField(null=True)),
+                ('students', django.contrib.postgres.fields.jsonb.JSONField(default=list)),
+                ('students_info', django.contrib.postgres.fields.jsonb.JSONField(default=list)),
+                ('images', django.contrib.postgres.fields.jsonb.JSONField(default=list)),
+                ('teacher_name', models.CharField(max_length=16, null=True)),
+                ('main_student_name', models.CharField(max_length=16, null=True)),
+                ('main_student_location', models.CharField(max_length=256, null=True)),
+                ('other_students', models.TextField(default='')),
+                ('search_document', models.TextField(default='')),
+                ('refresh_time', models.DateTimeField()),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='awardrecord',
+            name='award_search_document_idx',
+        ),
+        migrations.RemoveField(
+            model_name='awardrecord',
+            name='search_document',
+        ),
+        migrations.AddIndex(
+            model_name='recordsummary',
+            index=models.Index(fields=['-update_time', '-award_record'], name='summary_update_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recordsummary',
+            index=models.Index(fields=['review_status', '-update_time'], name='summary_review_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recordsummary',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_document'], name='summary_search_document_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_dataversion'),
+    ]
+
+    operations = [
+        # 并发上传可能留下了同一(award_record, category)的多行，只保留最新的一行
+        migrations.RunSQL(
+            sql="DELETE FROM api_image a USING api_image b "
+                "WHERE a.award_record_id = b.award_record_id AND a.category = b.category AND a.id < b.id",
+            reverse_sql=migrations.RunSQL.noop
+        ),
+        migrations.RemoveIndex(
+            model_name='image',
+            name='image_record_category_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='image',
+            constraint=models.UniqueConstraint(fields=('award_record', 'category'), name='image_record_category_unique'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_image_record_category_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recognition',
+            name='digest',
+            field=models.CharField(max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='recognition',
+            name='error',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='recognition',
+            name='status',
+            field=models.CharField(choices=[('WAITING', 'Waiting'), ('RUNNING', 'Running'), ('FINISHED', 'Finished'), ('FAILED', 'Failed')], default='WAITING', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='recognition',
+            name='update_time',
+            field=models.DateTimeField(null=True),
+        ),
+        # 已有的识别结果都是完成状态
+        migrations.RunSQL(
+            sql="UPDATE api_recognition SET status = 'FINISHED'",
+            reverse_sql=migrations.RunSQL.noop
+        ),
+    ]
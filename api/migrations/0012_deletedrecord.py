@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_recognition_worker'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('award_record_id', models.IntegerField()),
+                ('delete_time', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='recordsummary',
+            index=models.Index(fields=['refresh_time'], name='summary_refresh_time_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_deletedrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='partition',
+            field=models.CharField(choices=[('COLLEGE', 'College'), ('ID', 'Id')], max_length=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='volumes',
+            field=models.IntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_exportjob_volumes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='start_time',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
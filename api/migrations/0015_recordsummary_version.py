@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_exportjob_start_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordsummary',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
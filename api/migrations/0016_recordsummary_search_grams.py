@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:32
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_recordsummary_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordsummary',
+            name='search_grams',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=2), default=list, size=None),
+        ),
+        migrations.RunSQL(
+            # 与filters.RecordSummary.get_grams相同：逐行取单字与相邻两字，去重后按码位排序
+            sql="UPDATE api_recordsummary s SET search_grams = ARRAY("
+                "  SELECT DISTINCT substr(line, i, n) COLLATE \"C\" g "
+                "  FROM regexp_split_to_table(s.search_document, E'\\n') line, "
+                "       generate_series(1, char_length(line)) i, (VALUES (1), (2)) v(n) "
+                "  WHERE i + n - 1 <= char_length(line) ORDER BY g)",
+            reverse_sql=migrations.RunSQL.noop
+        ),
+        migrations.AddIndex(
+            model_name='recordsummary',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_grams'], name='summary_search_grams_idx'),
+        ),
+    ]
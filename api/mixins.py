@@ -0,0 +1,125 @@
+import hashlib
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count, Max
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from rest_framework import response, status
+from . import cache as app_cache
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetMixin:
+    """
+    为viewset的各个action声明查询预算。
+    debug模式下统计每次请求执行的SQL数量，超出预算时记录警告，用来及早发现N+1查询。
+    """
+    query_budget = {}   # action -> 允许的最大查询数
+
+    def dispatch(self, request, *args, **kwargs):
+        if not settings.DEBUG or not self.query_budget:
+            return super().dispatch(request, *args, **kwargs)
+        with CaptureQueriesContext(connection) as context:
+            res = super().dispatch(request, *args, **kwargs)
+        budget = self.query_budget.get(getattr(self, 'action', None), None)
+        if budget is not None and len(context.captured_queries) > budget:
+            logger.warning('%s.%s executed %s queries, exceeding its budget of %s.',
+                           self.__class__.__qualname__, self.action, len(context.captured_queries), budget)
+        return res
+
+
+class VersionCacheMixin:
+    """
+    为很少变化的只读接口提供条件请求与共享的响应缓存。
+    ETag由响应所依赖的数据表的版本号与请求路径计算得到，If-None-Match命中时只查询一次版本号就返回304；
+    否则从缓存中取出序列化结果，缓存未命中时才查询主表。版本号由管理端的写入递增，因此缓存无需主动清除。
+    """
+    cache_versions = ()             # 响应所依赖的数据表，见cache.Version
+    cache_timeout = 60 * 60 * 24    # seconds
+
+    def get_etag(self, request):
+        versions = app_cache.Version.get_many(self.cache_versions)
+        key = '%s|%s|%s|%s' % (self.__class__.__qualname__, request.accepted_renderer.format,
+                               request.get_full_path(), ','.join(str(v) for v in versions))
+        return '"%s"' % (hashlib.sha1(key.encode()).hexdigest(),)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return response.Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        key = 'api:version-cache:%s' % (etag.strip('"'),)
+        data = cache.get(key)
+        if data is None:
+            res = handler(request, *args, **kwargs)
+            if res.status_code != status.HTTP_200_OK:
+                return res
+            cache.set(key, res.data, self.cache_timeout)
+            for (name, value) in headers.items():
+                res[name] = value
+            return res
+        return response.Response(data, headers=headers)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+
+class UpdateTimeConditionMixin:
+    """
+    为列表与详情提供条件请求。ETag与Last-Modified由筛选后的查询集的最大修改时间与行数得到，
+    客户端的状态仍为最新时只执行一次聚合查询就返回304，不再查询关联数据与序列化。
+    时间取自事务开始时，先开始、后提交的修改不会使最大时间变大，因此ETag还包含condition_version_field的最大值。
+    """
+    condition_time_fields = ('update_time',)    # 任何影响响应内容的修改都会使其中至少一个字段变大
+    condition_version_field = None              # 可选。按提交顺序递增的字段，先开始、后提交的修改只能由它反映到ETag中
+
+    def get_condition(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.action == 'retrieve':
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            queryset = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        aggregates = {'time_%s' % (i,): Max(field) for (i, field) in enumerate(self.condition_time_fields)}
+        if self.condition_version_field is not None:
+            aggregates['version'] = Max(self.condition_version_field)
+        result = queryset.aggregate(count=Count('pk'), **aggregates)
+        times = [result[key] for key in aggregates.keys() if key != 'version' and result[key] is not None]
+        last_modified = max(times) if len(times) > 0 else None
+        key = '%s|%s|%s|%s|%s|%s|%s' % (self.__class__.__qualname__, request.user.pk, request.accepted_renderer.format,
+                                        request.get_full_path(), result['count'],
+                                        last_modified.isoformat() if last_modified is not None else '',
+                                        result.get('version', ''))
+        return '"%s"' % (hashlib.sha1(key.encode()).hexdigest(),), last_modified
+
+    def not_modified(self, request, etag, last_modified):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match is not None:
+            return etag in parse_etags(if_none_match)
+        # 仅凭时间无法发现列表中记录的删除，因此If-Modified-Since只用于详情
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return self.action == 'retrieve' and last_modified is not None and if_modified_since is not None and \
+            int(last_modified.timestamp()) <= if_modified_since
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        etag, last_modified = self.get_condition(request)
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if last_modified is not None:
+            headers['Last-Modified'] = http_date(last_modified.timestamp())
+        if self.not_modified(request, etag, last_modified):
+            return response.Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        res = handler(request, *args, **kwargs)
+        if res.status_code == status.HTTP_200_OK:
+            for (name, value) in headers.items():
+                res[name] = value
+        return res
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
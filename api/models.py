@@ -1,7 +1,10 @@
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User
-from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.contrib.postgres.indexes import GinIndex
 from . import enums
+import uuid
 
 # Create your models here.
 
@@ -101,21 +104,6 @@ class AwardRecord(models.Model):
     def review_status(self):
         return getattr(self, 'review').status if hasattr(self, 'review') else None
 
-    @property
-    def rating_category(self):
-        rating = self.competition_record.competition.rating_info
-        return rating.category if rating is not None else None
-
-    @property
-    def rating_level_title(self):
-        rating = self.competition_record.competition.rating_info
-        return rating.level_title if rating is not None else None
-
-    @property
-    def rating_level(self):
-        rating = self.competition_record.competition.rating_info
-        return rating.level if rating is not None else None
-
     @property
     def image_list(self):
         return self.images if hasattr(self, 'images') else Image.objects.none()
@@ -123,22 +111,83 @@ class AwardRecord(models.Model):
     def __str__(self):
         return '<%s>' % (self.competition_name,)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['submit_user', '-update_time'], name='award_submit_user_update_idx'),    # 学生的记录列表
+            models.Index(fields=['-update_time', '-id'], name='award_update_time_idx')                   # 时间范围筛选与排序
+        ]
+
+
+class RecordSummary(models.Model):
+    # AwardRecord的扁平化读模型，由services.Summary在各写入路径中同步维护
+    award_record = models.OneToOneField(AwardRecord, related_name='summary', primary_key=True, on_delete=models.CASCADE)
+    works_name = models.CharField(max_length=128, null=True)
+    award_level = models.CharField(max_length=16, null=False)
+    update_time = models.DateTimeField(null=False)
+
+    review_status = models.CharField(choices=enums.REVIEW_STATUS, max_length=12, null=True)
+    competition_name = models.CharField(max_length=128, null=True)
+    competition_category = models.CharField(max_length=128, null=True)
+    hold_time = models.DateField(null=True)
+    organizer = models.CharField(max_length=128, null=True)
+    rating_category = models.CharField(max_length=16, null=True)
+    rating_level_title = models.CharField(max_length=16, null=True)
+    rating_level = models.IntegerField(null=True)
+
+    teacher = models.CharField(max_length=32, null=True)                # card_id
+    teacher_info = JSONField(null=True)
+    main_student = models.CharField(max_length=32, null=True)           # card_id
+    main_student_info = JSONField(null=True)
+    students = JSONField(null=False, default=list)                     # [card_id]
+    students_info = JSONField(null=False, default=list)
+    images = JSONField(null=False, default=list)
+
+    teacher_name = models.CharField(max_length=16, null=True)           # 导出报表用的文本列
+    main_student_name = models.CharField(max_length=16, null=True)
+    main_student_location = models.CharField(max_length=256, null=True)
+    other_students = models.TextField(null=False, default='')
+
+    search_document = models.TextField(null=False, default='')         # 可搜索字段转小写后逐行拼接，见filters.RECORD_SEARCH_FIELDS
+    search_grams = ArrayField(models.CharField(max_length=2), null=False, default=list)   # 见filters.RecordSummary.get_grams
+    refresh_time = models.DateTimeField(null=False)                     # 写入所在事务的开始时间，增量导出用
+    version = models.BigIntegerField(null=False, default=0)             # 按提交顺序递增，见services.Summary.refresh
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-update_time', '-award_record'], name='summary_update_time_idx'),
+            models.Index(fields=['review_status', '-update_time'], name='summary_review_status_idx'),
+            models.Index(fields=['refresh_time'], name='summary_refresh_time_idx'),          # 增量导出
+            GinIndex(fields=['search_document'], name='summary_search_document_idx', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['search_grams'], name='summary_search_grams_idx')
+        ]
+
 
 class Image(models.Model):
     category = models.CharField(max_length=32, null=False)
-    file = models.CharField(max_length=256, null=False)
+    file = models.CharField(max_length=256, null=False)      # 以内容的sha256命名，相同内容的图片共享同一个文件
     award_record = models.ForeignKey(AwardRecord, on_delete=models.CASCADE, related_name='images')
     recognition = models.ForeignKey('Recognition', null=True, related_name='images', on_delete=models.SET_NULL)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['award_record', 'category'], name='image_record_category_unique')
+        ]
+
 
 class Recognition(models.Model):
     competition = models.ForeignKey('Competition', related_name='recognitions', on_delete=models.SET_NULL, null=True)
 
-    version = models.CharField(max_length=32, null=True)
+    version = models.CharField(max_length=32, null=True)            # 产生该结果的识别后端与版本
     category = models.CharField(max_length=32, null=False)
 
-    field_model = JSONField(null=False)
-    mapping_model = JSONField(null=False)
+    field_model = JSONField(null=False)                             # 识别出的原始内容
+    mapping_model = JSONField(null=False)                           # 从原始内容中提取的记录字段
+
+    digest = models.CharField(max_length=64, null=True, unique=True)    # 图片内容的sha256，相同内容的图片共用一个结果
+    status = models.CharField(choices=enums.RECOGNITION_STATUS, max_length=12,
+                              default=enums.RecognitionStatus.waiting, null=False)
+    error = models.TextField(null=True)
+    update_time = models.DateTimeField(null=True)
 
 
 class CompetitionRecord(models.Model):
@@ -151,11 +200,23 @@ class CompetitionRecord(models.Model):
     competition = models.ForeignKey('Competition', related_name='competition_records',
                                     on_delete=models.SET_NULL, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['name'], name='competition_record_name_idx')   # 审核时按名称匹配Competition
+        ]
+
 
 class Review(models.Model):
     status = models.CharField(choices=enums.REVIEW_STATUS, max_length=12, default=enums.ReviewStatus.waiting, null=False)
     award_record = models.OneToOneField(AwardRecord, related_name='review', on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'award_record'], name='review_status_idx'),
+            # 待审核队列只占全部记录的一小部分，单独建立部分索引
+            models.Index(fields=['award_record'], name='review_waiting_idx', condition=Q(status=enums.ReviewStatus.waiting))
+        ]
+
 
 class Competition(models.Model):
     name = models.CharField(max_length=128, null=False, primary_key=True)
@@ -164,18 +225,6 @@ class Competition(models.Model):
     organizer = models.CharField(max_length=128, null=False)
     rating_info = models.ForeignKey('RatingInfo', related_name='competitions', on_delete=models.SET_NULL, null=True)
 
-    @property
-    def rating_info_category(self):
-        return self.rating_info.category if self.rating_info is not None else None
-
-    @property
-    def rating_info_level_title(self):
-        return self.rating_info.level_title if self.rating_info is not None else None
-
-    @property
-    def rating_info_level(self):
-        return self.rating_info.level if self.rating_info is not None else None
-
 
 class RatingInfo(models.Model):
     competition_name = models.CharField(max_length=128, null=False, primary_key=True)
@@ -195,3 +244,29 @@ class AwardStudentRelation(models.Model):
 
 class GlobalSetting(models.Model):
     upload_enable = models.BooleanField(null=False, default=True)
+
+
+class ExportJob(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(choices=enums.EXPORT_STATUS, max_length=12, default=enums.ExportStatus.waiting, null=False)
+    params = JSONField(null=False)                              # 与admin/records相同的筛选参数
+    file = models.CharField(max_length=256, null=True)          # 生成的压缩包，位于TEMP_DIRS/exports；分卷时为目录
+    volumes = models.IntegerField(null=False, default=1)        # 分卷数量
+    partition = models.CharField(choices=enums.EXPORT_PARTITION, max_length=12, null=True)   # 分卷方式
+    error = models.TextField(null=True)
+
+    create_user = models.ForeignKey(User, related_name='export_jobs', null=True, on_delete=models.SET_NULL)
+    create_time = models.DateTimeField(null=False)
+    start_time = models.DateTimeField(null=True)
+    finish_time = models.DateTimeField(null=True)
+
+
+class DeletedRecord(models.Model):
+    # 已删除记录的墓碑，增量导出据此列出删除的记录。由signals在AwardRecord删除时写入
+    award_record_id = models.IntegerField(null=False)
+    delete_time = models.DateTimeField(null=False, db_index=True)
+
+
+class DataVersion(models.Model):
+    name = models.CharField(max_length=32, null=False, primary_key=True)    # 被缓存的一组数据
+    version = models.BigIntegerField(null=False, default=0)                  # 每次写入递增，各进程据此判断本地缓存是否过期
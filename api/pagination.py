@@ -0,0 +1,73 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import OrderedDict
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework import pagination, response, exceptions
+from rest_framework.utils.urls import replace_query_param
+
+
+class RecordPagination(pagination.LimitOffsetPagination):
+    """
+    默认仍是limit/offset分页。请求带有cursor参数(首页可以为空)时改用以(update_time, pk)倒序为键的游标分页：
+    每一页都只是一次索引范围扫描，不做COUNT，翻页期间新提交的记录也不会使后续页面错位。
+    """
+    cursor_query_param = 'cursor'
+    cursor_default_limit = 20
+    cursor_max_limit = 1000
+    cursor_fields = ('update_time', 'pk')
+    invalid_cursor_message = 'Invalid cursor'
+
+    cursor_mode = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view)
+        self.cursor_mode = True
+        self.request = request
+        self.limit = min(self.get_limit(request) or self.cursor_default_limit, self.cursor_max_limit)
+        (time_field, key_field) = self.cursor_fields
+        queryset = queryset.order_by('-%s' % (time_field,), '-%s' % (key_field,))
+        position = self.decode_cursor(request.query_params[self.cursor_query_param])
+        if position is not None:
+            (time_value, key_value) = position
+            queryset = queryset.filter(Q(**{'%s__lt' % (time_field,): time_value}) |
+                                       Q(**{time_field: time_value, '%s__lt' % (key_field,): key_value}))
+        results = list(queryset[:self.limit + 1])
+        self.next_position = None
+        if len(results) > self.limit:
+            results = results[:self.limit]
+            last = results[-1]
+            self.next_position = (getattr(last, time_field), getattr(last, key_field))
+        return results
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        return response.Response(OrderedDict([
+            ('next', self.get_next_cursor_link()),
+            ('results', data)
+        ]))
+
+    def get_next_cursor_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    @staticmethod
+    def encode_cursor(position):
+        (time_value, key_value) = position
+        return urlsafe_b64encode(('%s|%s' % (time_value.isoformat(), key_value)).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        if cursor == '':
+            return None
+        try:
+            (time_value, key_value) = urlsafe_b64decode(cursor.encode()).decode().split('|')
+            time_value = parse_datetime(time_value)
+            key_value = int(key_value)
+        except (TypeError, ValueError):
+            raise exceptions.NotFound(self.invalid_cursor_message)
+        if time_value is None:
+            raise exceptions.NotFound(self.invalid_cursor_message)
+        return time_value, key_value
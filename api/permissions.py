@@ -1,19 +1,11 @@
 from rest_framework import permissions
-from . import models as app_models
-from django.utils import timezone
+from . import models as app_models, services
 
 
 class BasePermission(permissions.BasePermission):
-    LOGIN_REFRESH_INTERVAL = 60 * 30     # seconds
-
     def has_permission(self, request, view):
         if request.user.is_authenticated:
-            user = request.user
-            now = timezone.now()
-            if user.last_login is None or \
-                    (now - user.last_login).seconds >= self.LOGIN_REFRESH_INTERVAL:
-                user.last_login = now
-                user.save()
+            services.LastSeen.touch(request.user)
 
 
 class IsLogin(BasePermission):
@@ -0,0 +1,216 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from PIL import Image as PILImage
+from . import models as app_models, enums, services, cache as app_cache, images as app_images
+import config
+import datetime
+import hashlib
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# 可选配置 config.RECOGNITION = {'BACKEND': 'baidu', 'WORKERS': 4, 'BATCH_SIZE': 32}
+RECOGNITION_CONFIG = getattr(config, 'RECOGNITION', None) or {}
+
+AWARD_LEVELS = ('特等奖', '一等奖', '二等奖', '三等奖', '优秀奖', '金奖', '银奖', '铜奖')
+
+
+class StubBackend:
+    # 不依赖网络的后端，只读出图片尺寸，用于离线测试整个流程
+    name = 'stub'
+    version = 'stub-1'
+
+    def recognize(self, path):
+        with PILImage.open(path) as image:
+            width, height = image.size
+        return {'words': [], 'width': width, 'height': height}
+
+
+class BaiduBackend:
+    # 百度通用文字识别。识别在工作线程中执行，AipOcr只是HTTP客户端，可以被多个线程共用
+    name = 'baidu'
+    version = 'baidu-general-1'
+
+    def __init__(self):
+        from aip import AipOcr
+        self.client = AipOcr(config.BAIDU_AIP['APP_ID'], config.BAIDU_AIP['API_KEY'], config.BAIDU_AIP['SECRET_KEY'])
+
+    def recognize(self, path):
+        with open(path, 'rb') as f:
+            result = self.client.basicGeneral(f.read())
+        if 'error_code' in result:
+            raise RuntimeError('%s: %s' % (result['error_code'], result.get('error_msg', '')))
+        return {'words': [item['words'] for item in result.get('words_result', [])]}
+
+
+BACKENDS = {
+    StubBackend.name: StubBackend,
+    BaiduBackend.name: BaiduBackend
+}
+
+
+def get_backend(name=None):
+    # 没有配置任何后端时返回None。stub只在显式指定时使用，否则它的空结果会被当作真实的识别结果缓存下来
+    if name is None:
+        name = RECOGNITION_CONFIG.get('BACKEND', None)
+    if name is None:
+        if not config.BAIDU_AIP.get('APP_ID'):
+            return None
+        name = BaiduBackend.name
+    if name not in BACKENDS:
+        raise ValueError('Unknown recognition backend %s.' % (name,))
+    return BACKENDS[name]()
+
+
+class Extractor:
+    # 从识别出的文字中提取记录字段，结果写入Recognition.mapping_model
+
+    @staticmethod
+    def extract(field_model):
+        text = ''.join(field_model.get('words', []))
+        mapping = {}
+        for level in AWARD_LEVELS:
+            if level in text:
+                mapping['award_level'] = level
+                break
+        # 取文字中出现的最长的竞赛名称
+        names = [name for name in app_cache.ReferenceCache.competition_names() if name and name in text]
+        if len(names) > 0:
+            mapping['competition_name'] = max(names, key=len)
+        return mapping
+
+
+class Worker:
+    # 批量识别尚未识别的图片。识别在有界的线程池中并发执行，数据库读写都在调用线程中完成
+    # 结果以图片内容的sha256缓存在Recognition.digest上，相同内容的图片只识别一次
+    BATCH_SIZE = RECOGNITION_CONFIG.get('BATCH_SIZE', 32)
+    WORKERS = RECOGNITION_CONFIG.get('WORKERS', 4)
+    STALE_TIME = datetime.timedelta(hours=1)    # 超过该时间仍为RUNNING的识别视为工作进程已中断
+    DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+    def __init__(self, backend=None, workers=None, batch_size=None):
+        self.backend = backend if backend is not None else get_backend()
+        if self.backend is None:
+            raise ValueError('No recognition backend is configured.')
+        self.workers = workers if workers is not None else Worker.WORKERS
+        self.batch_size = batch_size if batch_size is not None else Worker.BATCH_SIZE
+        self.skipped = set()
+
+    @staticmethod
+    def get_digest(image):
+        # ImageStore保存的文件以sha256命名，不需要再读取文件
+        stem = image.file.split('.', 1)[0]
+        if Worker.DIGEST_PATTERN.match(stem):
+            return stem
+        sha = hashlib.sha256()
+        with open(services.ImageStore.get_path(image.file), 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @staticmethod
+    def reset(retry_failed=False):
+        # 回收中断的识别；retry_failed时失败的识别也重新排队，并解除与图片的关联
+        now = timezone.now()
+        count = app_models.Recognition.objects.filter(digest__isnull=False, status=enums.RecognitionStatus.running,
+                                                      update_time__lt=now - Worker.STALE_TIME) \
+            .update(status=enums.RecognitionStatus.waiting, update_time=now)
+        if retry_failed:
+            failed = app_models.Recognition.objects.filter(digest__isnull=False, status=enums.RecognitionStatus.failed)
+            images = app_models.Image.objects.filter(recognition__in=failed)
+            record_ids = list(images.values_list('award_record_id', flat=True))
+            with transaction.atomic():
+                images.update(recognition=None)
+                count += failed.update(status=enums.RecognitionStatus.waiting, error=None, update_time=now)
+                services.Summary.refresh(record_ids)
+        return count
+
+    def recognize(self, name):
+        # 在线程池中执行：预处理（结果缓存在磁盘上）后交给后端识别
+        return self.backend.recognize(app_images.Preprocess.ensure(name))
+
+    def run_pending(self):
+        Worker.reset()
+        total = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                count = self.run_batch(pool)
+                if count == 0:
+                    break
+                total += count
+        return total
+
+    def get_stale(self, prefix=''):
+        # 由其他后端或版本产生的结果需要重新识别。没有digest的是旧版本在上传时同步识别的结果，保持不变
+        return Q(**{'%sdigest__isnull' % (prefix,): False,
+                    '%sstatus__in' % (prefix,): (enums.RecognitionStatus.finished, enums.RecognitionStatus.failed)}) & \
+            ~Q(**{'%sversion' % (prefix,): self.backend.version})
+
+    def run_batch(self, pool):
+        images = list(app_models.Image.objects.filter(Q(recognition__isnull=True) | self.get_stale('recognition__'))
+                      .exclude(id__in=self.skipped).order_by('id')[:self.batch_size])
+        if len(images) == 0:
+            return 0
+        images_by_digest = {}
+        for image in images:
+            try:
+                digest = Worker.get_digest(image)
+            except OSError as e:
+                logger.warning('Cannot read image %s: %s', image.file, e)
+                self.skipped.add(image.id)
+                continue
+            images_by_digest.setdefault(digest, []).append(image)
+
+        app_models.Recognition.objects.bulk_create([
+            app_models.Recognition(digest=digest, category=same[0].category, field_model={}, mapping_model={},
+                                   status=enums.RecognitionStatus.waiting, update_time=timezone.now())
+            for (digest, same) in images_by_digest.items()
+        ], ignore_conflicts=True)
+        # 认领等待中的识别。其他工作进程已经认领的行被跳过
+        with transaction.atomic():
+            claimed = list(app_models.Recognition.objects.select_for_update(skip_locked=True)
+                           .filter(Q(status=enums.RecognitionStatus.waiting) | self.get_stale(),
+                                   digest__in=images_by_digest.keys()))
+            app_models.Recognition.objects.filter(id__in=[r.id for r in claimed]) \
+                .update(status=enums.RecognitionStatus.running, update_time=timezone.now())
+
+        futures = {pool.submit(self.recognize, images_by_digest[recognition.digest][0].file): recognition
+                   for recognition in claimed}
+        for future in as_completed(futures):
+            recognition = futures[future]
+            recognition.version = self.backend.version
+            recognition.update_time = timezone.now()
+            try:
+                recognition.field_model = future.result()
+                recognition.mapping_model = Extractor.extract(recognition.field_model)
+                recognition.competition_id = recognition.mapping_model.get('competition_name', None)
+                recognition.status = enums.RecognitionStatus.finished
+                recognition.error = None
+            except Exception as e:
+                logger.warning('Recognition of %s failed: %s', recognition.digest, e)
+                recognition.status = enums.RecognitionStatus.failed
+                recognition.error = str(e)
+        app_models.Recognition.objects.bulk_update(
+            claimed, ('version', 'field_model', 'mapping_model', 'competition', 'status', 'error', 'update_time'))
+
+        # 已有当前版本结果（包括本批次产生的）的图片直接关联；仍在其他进程中识别的图片留到下一次
+        done = {r.digest: r for r in app_models.Recognition.objects.filter(
+            digest__in=images_by_digest.keys(), version=self.backend.version,
+            status__in=(enums.RecognitionStatus.finished, enums.RecognitionStatus.failed))}
+        record_ids = []
+        with transaction.atomic():
+            for (digest, same) in images_by_digest.items():
+                if digest not in done:
+                    self.skipped.update(image.id for image in same)
+                    continue
+                # 只关联文件没有在识别期间被替换的图片
+                app_models.Image.objects.filter(Q(recognition__isnull=True) | Q(recognition__digest=digest),
+                                                id__in=[image.id for image in same],
+                                                file__in={image.file for image in same}) \
+                    .update(recognition=done[digest])
+                record_ids += [image.award_record_id for image in same]
+            services.Summary.refresh(record_ids)
+        return len(images)
@@ -1,6 +1,6 @@
 from rest_framework import serializers, validators, exceptions
 from django.utils import timezone
-from . import models as app_models, enums
+from . import models as app_models, enums, cache as app_cache, images as app_images
 
 
 class Field:
@@ -9,10 +9,40 @@ class Field:
         category = serializers.CharField(read_only=True)
         file = serializers.CharField(read_only=True)
         recognition = serializers.PrimaryKeyRelatedField(read_only=True)
+        url = serializers.SerializerMethodField()
+        thumbnail = serializers.SerializerMethodField()
+        preview = serializers.SerializerMethodField()
+
+        @staticmethod
+        def get_url(obj):
+            return app_images.Derivative.get_url(obj.file)
+
+        @staticmethod
+        def get_thumbnail(obj):
+            return app_images.Derivative.get_url(obj.file, 'thumbnail')
+
+        @staticmethod
+        def get_preview(obj):
+            return app_images.Derivative.get_url(obj.file, 'preview')
 
         class Meta:
             model = app_models.Image
-            fields = ('id', 'category', 'file', 'recognition')
+            fields = ('id', 'category', 'file', 'recognition', 'url', 'thumbnail', 'preview')
+
+    class Rating(serializers.Field):
+        # 从ReferenceCache解析评级信息的一个属性，不访问数据库。source为竞赛名称(by_competition)或RatingInfo的主键
+        def __init__(self, attr, by_competition=False, **kwargs):
+            self.attr = attr
+            self.by_competition = by_competition
+            kwargs['read_only'] = True
+            super().__init__(**kwargs)
+
+        def to_representation(self, value):
+            if self.by_competition:
+                rating = app_cache.ReferenceCache.competition_rating(value)
+            else:
+                rating = app_cache.ReferenceCache.rating(value)
+            return getattr(rating, self.attr) if rating is not None else None
 
     class Student(serializers.ModelSerializer):
         card_id = serializers.CharField(max_length=32, allow_null=False, allow_blank=False)
@@ -86,9 +116,9 @@ class Student:
         organizer = serializers.CharField(max_length=128, allow_null=False)
 
         review_status = serializers.ChoiceField(choices=enums.REVIEW_STATUS, read_only=True)
-        rating_category = serializers.CharField(max_length=16, allow_null=False, read_only=True)
-        rating_level_title = serializers.CharField(max_length=16, allow_null=False, read_only=True)
-        rating_level = serializers.IntegerField(allow_null=False, read_only=True)
+        rating_category = Field.Rating('category', by_competition=True, source='competition_record.competition_id')
+        rating_level_title = Field.Rating('level_title', by_competition=True, source='competition_record.competition_id')
+        rating_level = Field.Rating('level', by_competition=True, source='competition_record.competition_id')
 
         images = Field.Image(many=True, source='image_list', read_only=True)
 
@@ -274,9 +304,9 @@ class Admin:
         hold_time = serializers.DateField(allow_null=False)
         organizer = serializers.CharField(max_length=128, allow_null=False)
         rating_info = serializers.PrimaryKeyRelatedField(queryset=app_models.RatingInfo.objects, allow_null=True)
-        rating_info_category = serializers.CharField(read_only=True)
-        rating_info_level_title = serializers.CharField(read_only=True)
-        rating_info_level = serializers.IntegerField(read_only=True)
+        rating_info_category = Field.Rating('category', source='rating_info_id')
+        rating_info_level_title = Field.Rating('level_title', source='rating_info_id')
+        rating_info_level = Field.Rating('level', source='rating_info_id')
 
         class Meta:
             model = app_models.Competition
@@ -323,9 +353,9 @@ class Admin:
         hold_time = serializers.DateField(read_only=True)
         organizer = serializers.CharField(read_only=True)
 
-        rating_category = serializers.CharField(max_length=16, allow_null=False, read_only=True)
-        rating_level_title = serializers.CharField(max_length=16, allow_null=False, read_only=True)
-        rating_level = serializers.IntegerField(allow_null=False, read_only=True)
+        rating_category = Field.Rating('category', by_competition=True, source='competition_record.competition_id')
+        rating_level_title = Field.Rating('level_title', by_competition=True, source='competition_record.competition_id')
+        rating_level = Field.Rating('level', by_competition=True, source='competition_record.competition_id')
 
         images = Field.Image(many=True, source='image_list', read_only=True)
 
@@ -376,3 +406,46 @@ class Admin:
                       'competition_name', 'competition_category', 'hold_time', 'organizer',
                       'review_status', 'rating_category', 'rating_level_title', 'rating_level', 'images',
                       'competition', 'rating_info')
+
+    class RecordReview(serializers.Serializer):
+        # 批量审核中的一项，字段含义与Record的审核字段相同。竞赛与评级在services.Batch.batch_review中统一查询
+        id = serializers.IntegerField(allow_null=False)
+        review_status = serializers.ChoiceField(choices=enums.REVIEW_STATUS)
+        competition = serializers.CharField(max_length=128, allow_null=True, required=False)
+        rating_info = serializers.CharField(max_length=128, allow_null=True, required=False)
+
+        class Meta:
+            fields = ('id', 'review_status', 'competition', 'rating_info')
+
+    class RecordSummary(serializers.ModelSerializer):
+        # 列表接口从RecordSummary读取，输出与Record相同
+        id = serializers.IntegerField(source='award_record_id', read_only=True)
+        teacher_info = serializers.JSONField(read_only=True)
+        students = serializers.JSONField(read_only=True)
+        students_info = serializers.JSONField(read_only=True)
+        main_student_info = serializers.JSONField(read_only=True)
+        images = serializers.JSONField(read_only=True)
+
+        class Meta:
+            model = app_models.RecordSummary
+            fields = ('id', 'works_name', 'award_level', 'update_time', 'teacher', 'students', 'main_student',
+                      'students_info', 'main_student_info', 'teacher_info',
+                      'competition_name', 'competition_category', 'hold_time', 'organizer',
+                      'review_status', 'rating_category', 'rating_level_title', 'rating_level', 'images')
+            read_only_fields = fields
+
+    class ExportJob(serializers.ModelSerializer):
+        id = serializers.UUIDField(read_only=True)
+        status = serializers.ChoiceField(choices=enums.EXPORT_STATUS, read_only=True)
+        params = serializers.JSONField(read_only=True)
+        volumes = serializers.IntegerField(read_only=True)
+        partition = serializers.ChoiceField(choices=enums.EXPORT_PARTITION, read_only=True)
+        error = serializers.CharField(read_only=True)
+        create_time = serializers.DateTimeField(read_only=True)
+        start_time = serializers.DateTimeField(read_only=True)
+        finish_time = serializers.DateTimeField(read_only=True)
+
+        class Meta:
+            model = app_models.ExportJob
+            fields = ('id', 'status', 'params', 'volumes', 'partition', 'error', 'create_time', 'start_time',
+                      'finish_time')
@@ -1,9 +1,37 @@
-from openpyxl import Workbook
-from . import models as app_models, serializers as app_serializers
-from CertificateManager.settings import TEMP_DIRS, IMAGE_DIRS
+from openpyxl import Workbook, load_workbook
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from django.apps import apps
+from django.contrib.postgres.fields.jsonb import KeyTextTransform
+from django.db import transaction, connection, connections
+from django.db.models import Prefetch, Q, Count, Max
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core import signing
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from . import models as app_models, serializers as app_serializers, filters as app_filters, enums
+from . import exceptions as app_exceptions, cache as app_cache, images as app_images
+from CertificateManager.settings import TEMP_DIRS, IMAGE_DIRS, IMAGE_SENDFILE, IMAGE_INTERNAL_URL
+from urllib.parse import quote
+import codecs
+import collections
+import csv
+import datetime
+import django
+import hashlib
+import io
+import json
+import logging
+import mimetypes
 import os
+import shutil
+import tempfile
+import threading
+import time
 import zipfile
 
+logger = logging.getLogger(__name__)
+
 EXCEL_RECORD_FIELD_NAME = {
     'id': '编号',
     'works_name': '作品名称',
@@ -50,6 +78,25 @@ EXCEL_RECORD_FIELD_COL_WIDTH = {
     'teacher': 10
 }
 
+IMPORT_STUDENT_FIELD_NAME = {
+    'card_id': '学号',
+    'name': '姓名',
+    'clazz_grade': '年级',
+    'clazz_number': '班级',
+    'subject': '专业',
+    'college': '学院'
+}
+IMPORT_STUDENT_FIELD_MAX_LENGTH = {
+    'card_id': 32,
+    'name': 16,
+    'subject': 64,
+    'college': 64
+}
+IMPORT_STUDENT_FIELD_RANGE = {          # 下限与Admin.ClassBatch相同，上限为数据库integer的范围
+    'clazz_grade': (1995, 2147483647),
+    'clazz_number': (1, 2147483647)
+}
+
 IMAGE_CATEGORY_NAME = {
     'NOTICE': '比赛通知',
     'AWARD': '获奖证书',
@@ -57,135 +104,1289 @@ IMAGE_CATEGORY_NAME = {
 }
 
 
+class Query:
+    # 列表/详情的查询预算。分页大小不影响查询数量: count + 主查询 + students预取 + images预取，其余为认证开销
+    RECORD_QUERY_BUDGET = {'list': 8, 'retrieve': 7, 'download': 7}
+
+    @staticmethod
+    def records(queryset):
+        # 序列化AwardRecord时会访问的全部关联，一次性join或预取
+        # 评级信息由ReferenceCache解析，不需要join competition与rating_info
+        return queryset.select_related('review', 'teacher', 'competition_record', 'main_student__clazz__subject__college') \
+            .prefetch_related(Prefetch('students',
+                                       queryset=app_models.Student.objects.select_related('clazz__subject__college')
+                                       .order_by('card_id')),
+                              Prefetch('images', queryset=app_models.Image.objects.order_by('id')))
+
+
 class Batch:
+    BULK_SIZE = 1000
+    MAX_REVIEW_SIZE = 5000  # 一次批量审核的最大记录数
+
     @staticmethod
-    def batch_class(data):
-        colleges = {}
-        subjects = {}
-        result = []
-        for d in data:
-            serializer = app_serializers.Admin.ClassBatch(data=d)
-            serializer.is_valid(raise_exception=True)
-
-            grade = serializer.validated_data['grade']
-            number = serializer.validated_data['number']
-            subject = serializer.validated_data['subject']
-            college = serializer.validated_data.get('college', None)
-
-            if college in colleges:
-                college_obj = colleges[college]
-            else:
-                college_obj = app_models.College.objects.filter(name=college).first()
-                if college_obj is None:
-                    college_obj = app_models.College(name=college)
-                    college_obj.save()
-                colleges[college] = college_obj
-
-            if subject in subjects:
-                subject_obj = subjects[subject]
-            else:
-                subject_obj = app_models.Subject.objects.filter(name=subject).first()
-                if subject_obj is None:
-                    subject_obj = app_models.Subject(name=subject, college=college_obj)
-                    subject_obj.save()
-                # 批处理将不修改现有的subject的college所属
-                subjects[subject] = subject_obj
-
-            obj = app_models.Class.objects.filter(grade=grade, number=number, subject=subject_obj).first()
+    def upsert(model, key, rows, update_fields=()):
+        # 以key为自然键批量写入：一次IN查询取出已存在的行，新行bulk_create，变化的行只更新update_fields
+        # rows中同一key出现多次时以最后一行为准。返回 (key -> 对象, 新建的对象, 修改了的对象)
+        latest = {row[key]: row for row in rows}
+        objects = {getattr(obj, key): obj for obj in model.objects.filter(**{'%s__in' % (key,): latest.keys()})}
+        new_objects, changed_objects = [], []
+        for (k, row) in latest.items():
+            obj = objects.get(k, None)
             if obj is None:
-                obj = app_models.Class(grade=grade, number=number, subject=subject_obj)
-                obj.save()
-            elif subject_obj != obj.subject:
-                obj.subject = subject_obj
-                obj.save()
-            result.append({'grade': grade, 'number': number, 'subject': subject, 'college': subject_obj.college.name})
+                new_objects.append(model(**row))
+            elif any(getattr(obj, field) != row[field] for field in update_fields):
+                for field in update_fields:
+                    setattr(obj, field, row[field])
+                changed_objects.append(obj)
+        for obj in model.objects.bulk_create(new_objects, batch_size=Batch.BULK_SIZE):
+            objects[getattr(obj, key)] = obj
+        if len(changed_objects) > 0:
+            model.objects.bulk_update(changed_objects, update_fields, batch_size=Batch.BULK_SIZE)
+        return objects, new_objects, changed_objects
+
+    @staticmethod
+    def resolve_classes(keys):
+        # keys: [(grade, number, subject, college)]。一次性查出涉及的学院/专业/班级，缺失的批量创建
+        # 返回 (grade, number, subject) -> Class，且Class.subject.college均已加载
+        colleges, _, _ = Batch.upsert(app_models.College, 'name', [{'name': college} for (_, _, _, college) in keys])
+        subject_rows = {}
+        for (_, _, subject, college) in keys:
+            if subject not in subject_rows:
+                subject_rows[subject] = {'name': subject, 'college_id': colleges[college].id}
+        # 批处理将不修改现有的subject的college所属
+        subjects, _, _ = Batch.upsert(app_models.Subject, 'name', subject_rows.values())
+        college_names = {c.id: c for c in colleges.values()}
+        for subject in subjects.values():
+            if subject.college_id in college_names:
+                subject.college = college_names[subject.college_id]
+
+        classes = {}
+        existing = app_models.Class.objects.filter(subject__in=[subjects[subject] for (_, _, subject, _) in keys],
+                                                   grade__in={grade for (grade, _, _, _) in keys},
+                                                   number__in={number for (_, number, _, _) in keys}).order_by('id')
+        for c in existing:
+            classes.setdefault((c.grade, c.number, c.subject_id), c)
+        new_classes = {}
+        for (grade, number, subject, _) in keys:
+            key = (grade, number, subjects[subject].id)
+            if key not in classes and key not in new_classes:
+                new_classes[key] = app_models.Class(grade=grade, number=number, subject=subjects[subject])
+        for c in app_models.Class.objects.bulk_create(new_classes.values(), batch_size=Batch.BULK_SIZE):
+            classes[(c.grade, c.number, c.subject_id)] = c
+
+        result = {}
+        for (grade, number, subject, _) in keys:
+            clazz = classes[(grade, number, subjects[subject].id)]
+            clazz.subject = subjects[subject]
+            result[(grade, number, subject)] = clazz
         return result
 
+    @staticmethod
+    def batch_class(data):
+        serializer = app_serializers.Admin.ClassBatch(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+        rows = serializer.validated_data
+        with transaction.atomic():
+            classes = Batch.resolve_classes([(row['grade'], row['number'], row['subject'], row.get('college', None))
+                                             for row in rows])
+            app_cache.Version.bump('college', 'subject', 'class')
+        return [{'grade': row['grade'], 'number': row['number'], 'subject': row['subject'],
+                 'college': classes[(row['grade'], row['number'], row['subject'])].college_name} for row in rows]
+
     @staticmethod
     def batch_student(data):
-        result = []
-        for d in data:
-            serializer = app_serializers.Admin.StudentBatch(data=d)
-            serializer.is_valid(raise_exception=True)
-
-            card_id = serializer.validated_data['card_id']
-            name = serializer.validated_data['name']
-            grade = serializer.validated_data['clazz_grade']
-            number = serializer.validated_data['clazz_number']
-            subject = serializer.validated_data['subject']
-            college = serializer.validated_data.get('college', None)
-
-            clazz_objects = Batch.batch_class([{'grade': grade, 'number': number, 'subject': subject, 'college': college}])
-            if len(clazz_objects) > 0:
-                clazz_obj = app_models.Class.objects.filter(grade=clazz_objects[0]['grade'],
-                                                            number=clazz_objects[0]['number'],
-                                                            subject__name=clazz_objects[0]['subject']).first()
+        serializer = app_serializers.Admin.StudentBatch(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+        rows = serializer.validated_data
+        with transaction.atomic():
+            classes = Batch.resolve_classes([(row['clazz_grade'], row['clazz_number'], row['subject'],
+                                              row.get('college', None)) for row in rows])
+            # 同一批次中card_id重复时，以最后一行为准
+            latest = {row['card_id']: row for row in rows}
+            students = {s.card_id: s for s in app_models.Student.objects.filter(card_id__in=latest.keys())}
+            new_students, changed_students = [], []
+            for (card_id, row) in latest.items():
+                clazz = classes[(row['clazz_grade'], row['clazz_number'], row['subject'])]
+                obj = students.get(card_id, None)
+                if obj is None:
+                    new_students.append(app_models.Student(card_id=card_id, name=row['name'], clazz=clazz))
+                elif obj.name != row['name'] or obj.clazz_id != clazz.id:
+                    obj.name = row['name']
+                    obj.clazz = clazz
+                    changed_students.append(obj)
+            app_models.Student.objects.bulk_create(new_students, batch_size=Batch.BULK_SIZE)
+            app_models.Student.objects.bulk_update(changed_students, ('name', 'clazz'), batch_size=Batch.BULK_SIZE)
+            app_cache.Version.bump('college', 'subject', 'class', 'student')
+            Summary.refresh_students([obj.id for obj in changed_students])
+        return [{'card_id': row['card_id'], 'name': row['name'], 'grade': row['clazz_grade'],
+                 'number': row['clazz_number'], 'subject': row['subject'],
+                 'college': classes[(row['clazz_grade'], row['clazz_number'], row['subject'])].college_name}
+                for row in rows]
+
+    @staticmethod
+    def read_rows(file):
+        # 逐行读取上传的xlsx/csv，不把整个文件解析进内存。返回 (行号, 行内容)
+        name = file.name.lower()
+        if name.endswith('.xlsx'):
+            workbook = load_workbook(file, read_only=True)
+            for (i, row) in enumerate(workbook.active.iter_rows(values_only=True)):
+                yield i + 1, row
+            workbook.close()
+        elif name.endswith('.csv'):
+            encoding = Batch.detect_encoding(file)
+            try:
+                for (i, row) in enumerate(csv.reader(io.TextIOWrapper(file, encoding=encoding))):
+                    yield i + 1, row
+            except UnicodeDecodeError:
+                raise app_exceptions.ApiError('InvalidEncoding', 'Cannot decode the file. Please save it as UTF-8 CSV.')
+        else:
+            raise app_exceptions.ApiError('UnsupportedFile', 'Only .xlsx and .csv files are supported.')
+
+    @staticmethod
+    def detect_encoding(file):
+        # 中文Windows上的Excel默认以GBK保存CSV。整个文件能按UTF-8解码时使用UTF-8，否则按gb18030（GBK的超集）读取
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            for chunk in iter(lambda: file.read(64 * 1024), b''):
+                decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+            encoding = 'utf-8-sig'
+        except UnicodeDecodeError:
+            encoding = 'gb18030'
+        file.seek(0)
+        return encoding
+
+    @staticmethod
+    def parse_student_row(row, columns):
+        # 返回 (行数据, 错误)，两者有且仅有一个不为None
+        values = {}
+        errors = {}
+        for (field, index) in columns.items():
+            value = row[index] if index < len(row) else None
+            value = str(value).strip() if value is not None else ''
+            if value == '':
+                errors[field] = 'This field is required.'
+            elif field in IMPORT_STUDENT_FIELD_RANGE:
+                (min_value, max_value) = IMPORT_STUDENT_FIELD_RANGE[field]
+                try:
+                    number = int(float(value))
+                except (ValueError, OverflowError):
+                    errors[field] = 'A valid integer is required.'
+                    continue
+                # 超出integer范围的值会使COPY失败，中止整个导入
+                if number < min_value:
+                    errors[field] = 'Ensure this value is greater than or equal to %s.' % (min_value,)
+                elif number > max_value:
+                    errors[field] = 'Ensure this value is less than or equal to %s.' % (max_value,)
+                else:
+                    values[field] = number
+            elif len(value) > IMPORT_STUDENT_FIELD_MAX_LENGTH[field]:
+                errors[field] = 'Ensure this field has no more than %s characters.' % (IMPORT_STUDENT_FIELD_MAX_LENGTH[field],)
             else:
-                clazz_obj = None
+                values[field] = value
+        if len(errors) > 0:
+            return None, errors
+        return values, None
 
-            obj = app_models.Student.objects.filter(card_id=card_id).first()
-            if obj is None:
-                obj = app_models.Student(card_id=card_id, name=name, clazz=clazz_obj)
-                obj.save()
+    IMPORT_COPY_SIZE = 10000     # 每次COPY写入暂存表的行数
+    IMPORT_MAX_ERRORS = 1000     # 响应中最多返回的错误行数
+
+    @staticmethod
+    def import_student(file):
+        rows = Batch.read_rows(file)
+        header = next(rows, None)
+        if header is None:
+            raise app_exceptions.ApiError('EmptyFile', 'The file is empty.')
+        titles = [str(title).strip() if title is not None else '' for title in header[1]]
+        columns = {}
+        for (field, name) in IMPORT_STUDENT_FIELD_NAME.items():
+            if field in titles:
+                columns[field] = titles.index(field)
+            elif name in titles:
+                columns[field] = titles.index(name)
             else:
-                obj.name = name
-                obj.clazz = clazz_obj
-                obj.save()
-            result.append({'card_id': card_id, 'name': name, 'grade': grade, 'number': number, 'subject': subject, 'college': obj.college_name})
-        return result
+                raise app_exceptions.ApiError('InvalidHeader', 'Column %s(%s) is missing.' % (field, name))
+
+        total = 0
+        errors = []
+        error_count = 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('CREATE TEMP TABLE student_import_staging ('
+                           '  line integer NOT NULL, card_id varchar(32) NOT NULL, name varchar(16) NOT NULL,'
+                           '  grade integer NOT NULL, number integer NOT NULL,'
+                           '  subject varchar(64) NOT NULL, college varchar(64) NOT NULL'
+                           ') ON COMMIT DROP')
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            buffered = 0
+            for (line, row) in rows:
+                if all(value is None or str(value).strip() == '' for value in row):
+                    continue
+                total += 1
+                values, error = Batch.parse_student_row(row, columns)
+                if error is not None:
+                    error_count += 1
+                    if len(errors) < Batch.IMPORT_MAX_ERRORS:
+                        errors.append({'row': line, 'detail': error})
+                    continue
+                writer.writerow((line, values['card_id'], values['name'], values['clazz_grade'],
+                                 values['clazz_number'], values['subject'], values['college']))
+                buffered += 1
+                if buffered >= Batch.IMPORT_COPY_SIZE:
+                    Batch.copy_staging(cursor, buffer)
+                    logger.info('Student import: %s rows read, %s invalid.', total, error_count)
+                    buffer = io.StringIO()
+                    writer = csv.writer(buffer)
+                    buffered = 0
+            if buffered > 0:
+                Batch.copy_staging(cursor, buffer)
+            created, updated = Batch.merge_staging(cursor)
+            app_cache.Version.bump('college', 'subject', 'class', 'student')
+            # 新建的学生还没有记录，只需要刷新信息发生了变化的学生的记录
+            Summary.refresh_students(updated)
+        return {'total': total, 'created': len(created), 'updated': len(updated), 'error_count': error_count,
+                'errors': errors}
+
+    @staticmethod
+    def copy_staging(cursor, buffer):
+        buffer.seek(0)
+        cursor.copy_expert('COPY student_import_staging (line, card_id, name, grade, number, subject, college) '
+                           'FROM STDIN WITH (FORMAT csv)', buffer)
+
+    @staticmethod
+    def merge_staging(cursor):
+        # 与resolve_classes的规则一致：不修改现有专业的所属学院；同一card_id以最后一行为准
+        tables = {
+            'college': app_models.College._meta.db_table,
+            'subject': app_models.Subject._meta.db_table,
+            'class': app_models.Class._meta.db_table,
+            'student': app_models.Student._meta.db_table
+        }
+        cursor.execute('ANALYZE student_import_staging')
+        cursor.execute('INSERT INTO {college} (name) '
+                       'SELECT DISTINCT college FROM student_import_staging '
+                       'ON CONFLICT (name) DO NOTHING'.format(**tables))
+        cursor.execute('INSERT INTO {subject} (name, college_id) '
+                       'SELECT DISTINCT ON (s.subject) s.subject, c.id '
+                       'FROM student_import_staging s JOIN {college} c ON c.name = s.college '
+                       'ORDER BY s.subject, s.line '
+                       'ON CONFLICT (name) DO NOTHING'.format(**tables))
+        cursor.execute('INSERT INTO {class} (grade, number, subject_id) '
+                       'SELECT DISTINCT s.grade, s.number, sub.id '
+                       'FROM student_import_staging s JOIN {subject} sub ON sub.name = s.subject '
+                       'WHERE NOT EXISTS (SELECT 1 FROM {class} c '
+                       '                  WHERE c.grade = s.grade AND c.number = s.number AND c.subject_id = sub.id)'
+                       .format(**tables))
+        cursor.execute('WITH upsert AS ('
+                       '  INSERT INTO {student} (card_id, name, clazz_id) '
+                       '  SELECT DISTINCT ON (s.card_id) s.card_id, s.name, c.id '
+                       '  FROM student_import_staging s JOIN {subject} sub ON sub.name = s.subject '
+                       '  JOIN LATERAL (SELECT id FROM {class} c '
+                       '                WHERE c.grade = s.grade AND c.number = s.number AND c.subject_id = sub.id '
+                       '                ORDER BY id LIMIT 1) c ON TRUE '
+                       '  ORDER BY s.card_id, s.line DESC '
+                       '  ON CONFLICT (card_id) DO UPDATE SET name = EXCLUDED.name, clazz_id = EXCLUDED.clazz_id '
+                       '  WHERE ({student}.name, {student}.clazz_id) IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.clazz_id) '
+                       '  RETURNING id, (xmax = 0) AS created'
+                       ') SELECT id, created FROM upsert'
+                       .format(**tables))
+        # 没有变化的行不会被改写，也不出现在RETURNING中。返回新建与修改的学生id
+        created, updated = [], []
+        for (student_id, is_created) in cursor.fetchall():
+            (created if is_created else updated).append(student_id)
+        return created, updated
+
+    @staticmethod
+    def batch_college(data):
+        serializer = app_serializers.Admin.College(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            Batch.upsert(app_models.College, 'name', serializer.validated_data)
+            app_cache.Version.bump('college')
+        return serializer.validated_data
+
+    @staticmethod
+    def batch_subject(data):
+        serializer = app_serializers.Admin.SubjectBatch(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+        rows = serializer.validated_data
+        with transaction.atomic():
+            colleges, _, _ = Batch.upsert(app_models.College, 'name', [{'name': row['college']} for row in rows])
+            _, _, updated = Batch.upsert(app_models.Subject, 'name',
+                                         [{'name': row['name'], 'college_id': colleges[row['college']].id}
+                                          for row in rows], ('college_id',))
+            app_cache.Version.bump('college', 'subject')
+            # 与signals.subject_saved相同：专业改属其他学院时刷新其学生的记录
+            Summary.refresh_students(app_models.Student.objects.filter(clazz__subject__in=updated).values('id'))
+        return [{'name': row['name'], 'college': row['college']} for row in rows]
 
     @staticmethod
     def batch_teacher(data):
+        serializer = app_serializers.Admin.Teacher(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            _, created, updated = Batch.upsert(app_models.Teacher, 'card_id', serializer.validated_data, ('name',))
+            if len(created) > 0 or len(updated) > 0:
+                app_cache.Version.bump('teacher')
+            # 新建的教师还没有记录，只需要刷新信息发生了变化的教师的记录
+            Summary.refresh_teachers([obj.id for obj in updated])
+        return serializer.validated_data
+
+    @staticmethod
+    def batch_rating_info(data):
+        serializer = app_serializers.Admin.RatingInfo(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            _, created, updated = Batch.upsert(app_models.RatingInfo, 'competition_name', serializer.validated_data,
+                                               ('category', 'level_title', 'level'))
+            # bulk写入不会触发信号，需要在刷新RecordSummary之前显式使缓存失效
+            if len(created) > 0 or len(updated) > 0:
+                app_cache.ReferenceCache.invalidate()
+            Summary.refresh_competitions(app_models.Competition.objects
+                                         .filter(rating_info__in=[obj.pk for obj in updated]).values('name'))
+        return serializer.validated_data
+
+    @staticmethod
+    def batch_review(data):
+        # 逐条给出结果，失败的条目不影响其他条目。竞赛与评级各只查询一次，全部写入在同一个事务中批量完成
+        serializer = app_serializers.Admin.RecordReview(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+        if len(serializer.validated_data) > Batch.MAX_REVIEW_SIZE:
+            raise app_exceptions.ApiError('TooManyRecords', 'At most %s records can be reviewed at once.'
+                                          % (Batch.MAX_REVIEW_SIZE,))
+        items = list({item['id']: item for item in serializer.validated_data}.values())
+        with transaction.atomic():
+            records = {record.id: record for record in app_models.AwardRecord.objects
+                       .select_related('review', 'competition_record__competition').select_for_update(of=('self',))
+                       .filter(id__in=[item['id'] for item in items])}
+            names, rating_names = set(), set()
+            for item in items:
+                record = records.get(item['id'], None)
+                if record is None or item['review_status'] != enums.ReviewStatus.passed:
+                    continue
+                if item.get('competition', None) is not None:
+                    names.add(item['competition'])
+                elif hasattr(record, 'competition_record') and record.competition_record.competition_id is None:
+                    names.add(record.competition_record.name)
+                    if item.get('rating_info', None) is not None:
+                        rating_names.add(item['rating_info'])
+            competitions = app_models.Competition.objects.in_bulk(names)
+            ratings = app_models.RatingInfo.objects.in_bulk(rating_names) if len(rating_names) > 0 else {}
+
+            results, new_reviews, changed_reviews, changed_competition_records = [], [], [], []
+            new_competitions = {}
+            for item in items:
+                record = records.get(item['id'], None)
+                if record is None:
+                    results.append(Batch.review_error(item, 'NotFound', 'Record does not exist.'))
+                    continue
+                competition = None
+                if item['review_status'] == enums.ReviewStatus.passed:
+                    if not hasattr(record, 'competition_record'):
+                        results.append(Batch.review_error(item, 'NoCompetitionRecord', 'Record has no competition.'))
+                        continue
+                    competition_record = record.competition_record
+                    if item.get('competition', None) is not None:
+                        competition = competitions.get(item['competition'], None) or \
+                            new_competitions.get(item['competition'], None)
+                        if competition is None:
+                            results.append(Batch.review_error(item, 'CompetitionNotFound',
+                                                              'Competition %s does not exist.' % (item['competition'],)))
+                            continue
+                    elif competition_record.competition_id is not None:
+                        competition = competition_record.competition
+                    else:
+                        competition = competitions.get(competition_record.name, None) or \
+                            new_competitions.get(competition_record.name, None)
+                        if competition is None:
+                            if item.get('rating_info', None) is None:
+                                results.append(Batch.review_error(item, 'RatingInfoRequired', 'rating_info is necessary.'))
+                                continue
+                            if item['rating_info'] not in ratings:
+                                results.append(Batch.review_error(item, 'RatingInfoNotFound',
+                                                                  'Rating info %s does not exist.' % (item['rating_info'],)))
+                                continue
+                            competition = app_models.Competition(name=competition_record.name,
+                                                                 category=competition_record.category,
+                                                                 hold_time=competition_record.hold_time,
+                                                                 organizer=competition_record.organizer,
+                                                                 rating_info=ratings[item['rating_info']])
+                            new_competitions[competition.name] = competition
+                    competition_record.competition = competition
+                    competition_record.name = competition.name
+                    competition_record.category = competition.category
+                    competition_record.organizer = competition.organizer
+                    competition_record.hold_time = competition.hold_time
+                    changed_competition_records.append(competition_record)
+                if hasattr(record, 'review'):
+                    record.review.status = item['review_status']
+                    changed_reviews.append(record.review)
+                else:
+                    new_reviews.append(app_models.Review(award_record=record, status=item['review_status']))
+                results.append({'id': record.id, 'success': True, 'review_status': item['review_status'],
+                                'competition': competition.name if competition is not None else None})
+
+            if len(new_competitions) > 0:
+                app_models.Competition.objects.bulk_create(new_competitions.values(), batch_size=Batch.BULK_SIZE,
+                                                           ignore_conflicts=True)
+                # bulk写入不会触发信号
+                app_cache.ReferenceCache.invalidate()
+            app_models.Review.objects.bulk_create(new_reviews, batch_size=Batch.BULK_SIZE)
+            if len(changed_reviews) > 0:
+                app_models.Review.objects.bulk_update(changed_reviews, ('status',), batch_size=Batch.BULK_SIZE)
+            if len(changed_competition_records) > 0:
+                app_models.CompetitionRecord.objects.bulk_update(
+                    changed_competition_records, ('competition', 'name', 'category', 'organizer', 'hold_time'),
+                    batch_size=Batch.BULK_SIZE)
+            Summary.refresh([result['id'] for result in results if result['success']])
+        return results
+
+    @staticmethod
+    def review_error(item, code, detail):
+        return {'id': item['id'], 'success': False, 'code': code, 'detail': detail}
+
+
+class Summary:
+    # 维护RecordSummary。管理端的列表、筛选、搜索与导出只读这一张表
+    REFRESH_SIZE = 500
+    VERSION_NAME = 'summary'
+
+    @staticmethod
+    def build(record, now, version):
+        data = app_serializers.Admin.Record(record).data
+        competition_record = getattr(record, 'competition_record', None)
+        teacher_info = data['teacher_info']
+        main_student_info = data['main_student_info']
+        students_info = data['students_info']
+        main_student_location = None
+        # 班级被删除后学生的clazz为空，序列化结果中没有班级相关的字段
+        if main_student_info is not None and main_student_info.get('college', None) is not None:
+            main_student_location = '%s %s%s级%s班' % (main_student_info['college'], main_student_info['subject'],
+                                                     main_student_info['clazz_grade'], main_student_info['clazz_number'])
+        searchable = [record.works_name, record.award_level,
+                      competition_record.name if competition_record is not None else None,
+                      teacher_info['name'] if teacher_info is not None else None,
+                      main_student_info['name'] if main_student_info is not None else None] + \
+                     [student['name'] for student in students_info]
+        search_document = '\n'.join(value for value in searchable if value).lower()
+        return app_models.RecordSummary(
+            award_record_id=record.id,
+            works_name=record.works_name,
+            award_level=record.award_level,
+            update_time=record.update_time,
+            review_status=data['review_status'],
+            competition_name=data['competition_name'],
+            competition_category=data['competition_category'],
+            hold_time=competition_record.hold_time if competition_record is not None else None,
+            organizer=data['organizer'],
+            rating_category=data.get('rating_category', None),
+            rating_level_title=data.get('rating_level_title', None),
+            rating_level=data.get('rating_level', None),
+            teacher=data['teacher'],
+            teacher_info=teacher_info,
+            main_student=data['main_student'],
+            main_student_info=main_student_info,
+            students=data['students'],
+            students_info=students_info,
+            images=data['images'],
+            teacher_name=teacher_info['name'] if teacher_info is not None else None,
+            main_student_name=main_student_info['name'] if main_student_info is not None else None,
+            main_student_location=main_student_location,
+            other_students=', '.join(student['name'] for student in students_info),
+            search_document=search_document,
+            search_grams=app_filters.RecordSummary.get_grams(search_document),
+            refresh_time=now,
+            version=version
+        )
+
+    @staticmethod
+    def refresh(record_ids):
+        record_ids = list(set(record_ids))
+        for i in range(0, len(record_ids), Summary.REFRESH_SIZE):
+            chunk = record_ids[i:i + Summary.REFRESH_SIZE]
+            with transaction.atomic():
+                # refresh_time取写入所在事务的开始时间，增量导出据此判断哪些修改可能尚未提交，见Delta.prepare。
+                # 先开始的事务可能后提交，它的refresh_time不会使最大值变大。导出缓存与条件请求使用按提交顺序递增的version
+                now = Summary.transaction_time()
+                version = app_cache.Version.next(Summary.VERSION_NAME)
+                summaries = [Summary.build(record, now, version)
+                             for record in Query.records(app_models.AwardRecord.objects.filter(id__in=chunk))]
+                app_models.RecordSummary.objects.filter(award_record_id__in=chunk).delete()
+                app_models.RecordSummary.objects.bulk_create(summaries)
+
+    @staticmethod
+    def transaction_time():
+        # PostgreSQL的now()是当前事务的开始时间，与pg_stat_activity.xact_start相同
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT now()')
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def refresh_queryset(queryset):
+        Summary.refresh(queryset.values_list('id', flat=True).distinct())
+
+    @staticmethod
+    def refresh_students(student_ids):
+        Summary.refresh_queryset(app_models.AwardRecord.objects.filter(Q(main_student__in=student_ids) |
+                                                                       Q(students__in=student_ids)))
+
+    @staticmethod
+    def refresh_teachers(teacher_ids):
+        Summary.refresh_queryset(app_models.AwardRecord.objects.filter(teacher__in=teacher_ids))
+
+    @staticmethod
+    def refresh_competitions(competition_names):
+        Summary.refresh_queryset(app_models.AwardRecord.objects.filter(competition_record__competition__in=competition_names))
+
+    @staticmethod
+    def rebuild(check=False):
+        # 从头重建全部RecordSummary。check=True时只比对，不写入。返回 (缺失, 多余, 内容不一致) 的记录id
+        fields = [f.attname for f in app_models.RecordSummary._meta.concrete_fields
+                  if f.attname not in ('refresh_time', 'version')]
+        record_ids = list(app_models.AwardRecord.objects.order_by('id').values_list('id', flat=True))
+        missing, drifted = [], []
+        now = timezone.now()
+        for i in range(0, len(record_ids), Summary.REFRESH_SIZE):
+            chunk = record_ids[i:i + Summary.REFRESH_SIZE]
+            stored = {s.award_record_id: s for s in app_models.RecordSummary.objects.filter(award_record_id__in=chunk)}
+            for record in Query.records(app_models.AwardRecord.objects.filter(id__in=chunk)):
+                summary = Summary.build(record, now, 0)
+                current = stored.get(record.id, None)
+                if current is None:
+                    missing.append(record.id)
+                elif any(Summary.normalize(getattr(summary, f)) != Summary.normalize(getattr(current, f)) for f in fields):
+                    drifted.append(record.id)
+        extra = list(app_models.RecordSummary.objects.exclude(award_record_id__in=app_models.AwardRecord.objects.values('id'))
+                     .values_list('award_record_id', flat=True))
+        if not check:
+            Summary.refresh(missing + drifted)
+            app_models.RecordSummary.objects.filter(award_record_id__in=extra).delete()
+        return missing, extra, drifted
+
+    @staticmethod
+    def normalize(value):
+        # 序列化器输出的OrderedDict与数据库读出的dict比较前统一为普通类型
+        return json.loads(json.dumps(value, default=str)) if isinstance(value, (dict, list)) else value
+
+
+class LastSeen:
+    # 记录用户的最近活动时间。权限检查只写入进程内缓冲区，由flush定期合并为一条UPDATE写回last_login
+    REFRESH_INTERVAL = 60 * 30      # seconds，last_login距今小于该间隔时不再记录
+    FLUSH_INTERVAL = 60             # seconds
+    FLUSH_SIZE = 1000               # 每条UPDATE语句最多更新的用户数
+
+    _lock = threading.Lock()
+    _pending = {}                   # user id -> 最近活动时间
+    _last_flush = time.monotonic()
+
+    @staticmethod
+    def touch(user):
+        now = timezone.now()
+        if user.last_login is not None and (now - user.last_login).total_seconds() < LastSeen.REFRESH_INTERVAL:
+            return
+        with LastSeen._lock:
+            LastSeen._pending[user.id] = now
+
+    @staticmethod
+    def flush(force=False):
+        with LastSeen._lock:
+            if not force and time.monotonic() - LastSeen._last_flush < LastSeen.FLUSH_INTERVAL:
+                return
+            pending = LastSeen._pending
+            LastSeen._pending = {}
+            LastSeen._last_flush = time.monotonic()
+        if len(pending) == 0:
+            return
+        items = list(pending.items())
+        table = app_models.User._meta.db_table
+        with connection.cursor() as cursor:
+            for i in range(0, len(items), LastSeen.FLUSH_SIZE):
+                chunk = items[i:i + LastSeen.FLUSH_SIZE]
+                cursor.execute('UPDATE {table} SET last_login = v.last_login '
+                               'FROM (VALUES {values}) AS v (id, last_login) '
+                               'WHERE {table}.id = v.id AND ({table}.last_login IS NULL OR {table}.last_login < v.last_login)'
+                               .format(table=table, values=', '.join(['(%s, %s::timestamptz)'] * len(chunk))),
+                               [value for item in chunk for value in item])
+
+
+class ImageStore:
+    # 图片文件以内容的sha256命名：相同内容只保存一份，学生重试上传时不会再写入磁盘
+    # 同名文件的写入与删除都在以文件名为键的advisory lock下进行，避免删除一个刚刚被其他记录引用的文件
+
+    @staticmethod
+    def get_path(name):
+        return os.path.join(IMAGE_DIRS, name)
+
+    @staticmethod
+    def get_name(file, ext):
+        sha = hashlib.sha256()
+        for chunk in file.chunks():
+            sha.update(chunk)
+        return '%s.%s' % (sha.hexdigest(), ext.lower()) if ext else sha.hexdigest()
+
+    @staticmethod
+    def lock(name):
+        # 事务级锁，随事务结束释放
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', [name])
+
+    @staticmethod
+    def write(file, name):
+        # 先写入同目录下的临时文件，完成后原子地rename，读者不会看到写了一半的文件
+        path = ImageStore.get_path(name)
+        if os.path.exists(path):
+            return
+        if not os.path.exists(IMAGE_DIRS):
+            os.makedirs(IMAGE_DIRS, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=IMAGE_DIRS, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in file.chunks():
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def save(record_id, category, file, ext):
+        name = ImageStore.get_name(file, ext)
+        with transaction.atomic():
+            ImageStore.lock(name)
+            ImageStore.write(file, name)
+            # 锁住记录行，同一记录的并发上传依次执行
+            app_models.AwardRecord.objects.select_for_update().filter(id=record_id).first()
+            image = app_models.Image.objects.filter(award_record_id=record_id, category=category).first()
+            old_name = None
+            if image is None:
+                image = app_models.Image(award_record_id=record_id, category=category, file=name)
+            elif image.file != name:
+                old_name = image.file
+                image.file = name
+                image.recognition = None
+            image.save()
+            Summary.refresh([record_id])
+            if old_name is not None:
+                transaction.on_commit(lambda: ImageStore.release(old_name))
+        app_images.Derivative.ensure(name)
+        return image
+
+    @staticmethod
+    def release(name):
+        # 文件可能仍被其他Image引用，只删除不再被引用的文件
+        with transaction.atomic():
+            ImageStore.lock(name)
+            if not app_models.Image.objects.filter(file=name).exists():
+                path = ImageStore.get_path(name)
+                if os.path.exists(path):
+                    os.remove(path)
+                app_images.Derivative.remove(name)
+
+
+class Delivery:
+    # 发送已经通过权限检查的图片。部署时交给前端代理发送，开发环境中由django以流的方式发送并支持Range请求
+    CHUNK_SIZE = 64 * 1024
+    MAX_AGE = 60 * 60 * 24 * 365    # seconds。同一文件名的内容不会改变
+
+    @staticmethod
+    def iter_file(path, start, length):
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while length > 0:
+                chunk = f.read(min(Delivery.CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+
+    @staticmethod
+    def parse_range(header, size):
+        # 只支持单个区间。返回 (start, end)；没有Range时返回None；区间无法满足时抛出ValueError
+        if header is None or not header.startswith('bytes=') or ',' in header:
+            return None
+        start, _, end = header[len('bytes='):].strip().partition('-')
+        if start == '':
+            if end == '' or int(end) == 0:
+                raise ValueError(header)
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end != '' else size - 1
+        if start >= size or start > end:
+            raise ValueError(header)
+        return start, end
+
+    @staticmethod
+    def response(request, path):
+        stat = os.stat(path)
+        etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': http_date(stat.st_mtime),
+            'Cache-Control': 'private, max-age=%s, immutable' % (Delivery.MAX_AGE,)
+        }
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if (if_none_match is not None and etag in parse_etags(if_none_match)) or \
+                (if_none_match is None and if_modified_since is not None and int(stat.st_mtime) <= if_modified_since):
+            res = HttpResponse(status=304)
+        elif IMAGE_SENDFILE == 'nginx':
+            res = HttpResponse(content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+            res['X-Accel-Redirect'] = IMAGE_INTERNAL_URL + quote(os.path.relpath(path, IMAGE_DIRS))
+        elif IMAGE_SENDFILE == 'apache':
+            res = HttpResponse(content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+            res['X-Sendfile'] = path
+        else:
+            res = Delivery.stream(request, path, stat.st_size, etag)
+        for (name, value) in headers.items():
+            res[name] = value
+        return res
+
+    @staticmethod
+    def stream(request, path, size, etag):
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if_range = request.META.get('HTTP_IF_RANGE', None)
+        try:
+            byte_range = Delivery.parse_range(request.META.get('HTTP_RANGE', None), size) \
+                if if_range is None or if_range == etag else None
+        except ValueError:
+            res = HttpResponse(status=416)
+            res['Content-Range'] = 'bytes */%s' % (size,)
+            return res
+        if byte_range is None:
+            res = StreamingHttpResponse(Delivery.iter_file(path, 0, size), content_type=content_type)
+            res['Content-Length'] = str(size)
+        else:
+            start, end = byte_range
+            res = StreamingHttpResponse(Delivery.iter_file(path, start, end - start + 1),
+                                        status=206, content_type=content_type)
+            res['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+            res['Content-Length'] = str(end - start + 1)
+        res['Accept-Ranges'] = 'bytes'
+        return res
+
+
+class ZipStream:
+    # 作为zipfile的写入目标，暂存已写入但还没有发送给客户端的字节
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
         pass
 
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
 
 class Download:
+    CHUNK_SIZE = 2000   # 服务端游标每次取回的记录数
+    PREFETCH_WORKERS = 8                    # 预读图片文件的线程数
+    PREFETCH_BYTES = 64 * 1024 * 1024       # 已预读到内存、尚未写出的最大字节数
+    PREFETCH_MAX_SIZE = 8 * 1024 * 1024     # 超过该大小的文件不预读到内存
+    # 已经压缩过的格式，在压缩包中直接存储
+    STORED_EXTS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.zip', '.gz'}
+
+    # 报表所需的列，直接由RecordSummary的values()投影得到
+    RECORD_VALUES = {
+        'id': 'award_record_id',
+        'works_name': 'works_name',
+        'award_level': 'award_level',
+        'competition_name': 'competition_name',
+        'competition_category': 'competition_category',
+        'hold_time': 'hold_time',
+        'organizer': 'organizer',
+        'rating_category': 'rating_category',
+        'rating_level_title': 'rating_level_title',
+        'main_student_location': 'main_student_location',
+        'main_student': 'main_student_name',
+        'other_students': 'other_students',
+        'teacher': 'teacher_name'
+    }
+
+    @staticmethod
+    def iter_excel_rows(queryset):
+        # queryset为RecordSummary，单表顺序扫描
+        queryset = queryset.values(*Download.RECORD_VALUES.values())
+        for row in queryset.iterator(chunk_size=Download.CHUNK_SIZE):
+            record = {field: row[column] for (field, column) in Download.RECORD_VALUES.items()}
+            if record['hold_time'] is not None:
+                record['hold_time'] = record['hold_time'].isoformat()
+            yield record
+
     @staticmethod
-    def generate_excel(data, filepath):
-        workbook = Workbook()
-        sheet = workbook.active
-        sheet.title = '竞赛记录表'
-        for (field, col) in EXCEL_RECORD_FIELD_COL.items():
-            sheet['%s1' % (col,)] = EXCEL_RECORD_FIELD_NAME[field]
-            sheet.column_dimensions[col].width = EXCEL_RECORD_FIELD_COL_WIDTH[field]
-        cnt = 1
-        for record in data:
-            cnt += 1
-            if record['teacher'] is not None:
-                record['teacher'] = record['teacher_info']['name']
-            if record['main_student'] is not None:
-                info = record['main_student_info']
-                record['main_student_location'] = '%s %s%s级%s班' % (info['college'], info['subject'], info['clazz_grade'], info['clazz_number'])
-                record['main_student'] = info['name']
-            if record['students'] is not None:
-                record['other_students'] = ', '.join(student['name'] for student in record['students_info'])
-            for (field, col) in EXCEL_RECORD_FIELD_COL.items():
-                sheet['%s%s' % (col, cnt)] = record.get(field, None)
+    def generate_excel(queryset, filepath):
+        # write-only模式逐行写出，内存占用与记录数无关
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('竞赛记录表')
+        fields = sorted(EXCEL_RECORD_FIELD_COL.keys(), key=lambda f: EXCEL_RECORD_FIELD_COL[f])
+        for field in fields:
+            sheet.column_dimensions[EXCEL_RECORD_FIELD_COL[field]].width = EXCEL_RECORD_FIELD_COL_WIDTH[field]
+        sheet.append([EXCEL_RECORD_FIELD_NAME[field] for field in fields])
+        for record in Download.iter_excel_rows(queryset):
+            sheet.append([record.get(field, None) for field in fields])
         workbook.save(filepath)
 
     @staticmethod
-    def generate_zip(data, uid):
-        if not os.path.exists(TEMP_DIRS):
-            os.mkdir(TEMP_DIRS)
-        Download.generate_excel(data, '%s/%s.xlsx' % (TEMP_DIRS, uid))
-        image_list = []
-        for item in data:
-            for image in item['images']:
-                if 'file' in image and 'category' in image:
-                    image_list.append((
-                        '%s/%s' % (IMAGE_DIRS, image['file']),
-                        '%s-%s%s' % (item['id'], IMAGE_CATEGORY_NAME[image['category']], Download.get_ext(image['file']))
-                    ))
-        with zipfile.ZipFile('%s/%s.zip' % (TEMP_DIRS, uid), 'w') as package:
-            package.write('%s/%s.xlsx' % (TEMP_DIRS, uid), arcname='报表.xlsx')
+    def iter_zip(queryset, manifest=None):
+        # 边打包边输出，不落地任何临时文件。zipfile在不可seek的目标上会改用data descriptor记录长度
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, 'w') as package:
+            if manifest is not None:
+                package.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2),
+                                 compress_type=zipfile.ZIP_DEFLATED)
+            excel = io.BytesIO()
+            Download.generate_excel(queryset, excel)
+            package.writestr('报表.xlsx', excel.getvalue(), compress_type=zipfile.ZIP_DEFLATED)
+            del excel
+            yield stream.pop()
+            for (info, filepath, data) in Download.prefetch_images(Download.get_image_list(queryset)):
+                if data is not None:
+                    package.writestr(info, data)
+                    yield stream.pop()
+                    continue
+                # 过大的文件没有预读，仍在当前线程中分块读出
+                with open(filepath, 'rb') as src, package.open(info, 'w') as dst:
+                    while True:
+                        chunk = src.read(ZipStream.CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        yield stream.pop()
+                yield stream.pop()
+        yield stream.pop()
+
+    @staticmethod
+    def prefetch_images(image_list):
+        # 图片文件在线程池中预读，按原顺序产出(ZipInfo, 路径, 内容)。
+        # 提交读取前先取得文件大小，已读取但尚未写出的字节数不超过PREFETCH_BYTES，内存占用与文件数量无关
+        pending = collections.deque()
+        pending_bytes = 0
+        pool = ThreadPoolExecutor(max_workers=Download.PREFETCH_WORKERS)
+        try:
             for (filepath, filename) in image_list:
-                package.write(filepath, arcname=filename)
-        os.remove('%s/%s.xlsx' % (TEMP_DIRS, uid))
-        return '%s/%s.zip' % (TEMP_DIRS, uid)
+                info = Download.get_image_info(filepath, filename)
+                if info is None:
+                    continue
+                # 过大的文件不预读，由调用方分块读出
+                prefetch = info.file_size <= Download.PREFETCH_MAX_SIZE
+                size = info.file_size if prefetch else 0
+                while pending and pending_bytes + size > Download.PREFETCH_BYTES:
+                    result, pending_bytes = Download.pop_prefetched(pending, pending_bytes)
+                    if result is not None:
+                        yield result
+                future = pool.submit(Download.read_image, filepath) if prefetch else None
+                pending.append((future, info, filepath, size))
+                pending_bytes += size
+            while pending:
+                result, pending_bytes = Download.pop_prefetched(pending, pending_bytes)
+                if result is not None:
+                    yield result
+        finally:
+            # 客户端中途断开时丢弃尚未开始的读取
+            for (future, _, _, _) in pending:
+                if future is not None:
+                    future.cancel()
+            pool.shutdown(wait=True)
+
+    @staticmethod
+    def pop_prefetched(pending, pending_bytes):
+        future, info, filepath, size = pending.popleft()
+        if future is None:
+            return (info, filepath, None), pending_bytes
+        data = future.result()
+        return ((info, filepath, data) if data is not None else None), pending_bytes - size
+
+    @staticmethod
+    def get_image_info(filepath, filename):
+        try:
+            info = zipfile.ZipInfo.from_file(filepath, arcname=filename)
+        except FileNotFoundError:
+            return None
+        # JPEG/PNG等格式本身已经压缩过，再deflate只消耗CPU
+        if os.path.splitext(filename)[1].lower() in Download.STORED_EXTS:
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        return info
+
+    @staticmethod
+    def read_image(filepath):
+        try:
+            with open(filepath, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def get_image_list(queryset):
+        for (record_id, images) in queryset.values_list('award_record_id', 'images').iterator(chunk_size=Download.CHUNK_SIZE):
+            for image in images:
+                if image.get('file', None) is not None and image.get('category', None) in IMAGE_CATEGORY_NAME:
+                    yield (
+                        '%s/%s' % (IMAGE_DIRS, image['file']),
+                        '%s-%s%s' % (record_id, IMAGE_CATEGORY_NAME[image['category']], Download.get_ext(image['file']))
+                    )
 
     @staticmethod
     def get_ext(filename):
-        location = filename.rindex('.')
-        if location >= 0:
-            return filename[location:]
-        return ''
+        # 上传时没有扩展名的图片以不带扩展名的sha256保存
+        return os.path.splitext(filename)[1]
+
+
+class Delta:
+    # 增量导出。水位由服务端签名签发，记录上一次导出覆盖到的RecordSummary.refresh_time与筛选参数。
+    # 记录及其引用的学生、教师、竞赛、图片的任何修改都会刷新refresh_time
+    SALT = 'api.services.Delta'
+    LAG = datetime.timedelta(minutes=1)             # 水位与数据库当前时间至少相差该值，作为额外的余量
+    TOMBSTONE_EXPIRE = datetime.timedelta(days=180)  # 删除记录的保留时间，更早的水位不再接受
+
+    @staticmethod
+    def dumps(time, params):
+        return signing.dumps({'time': time.isoformat(), 'params': params}, salt=Delta.SALT)
+
+    @staticmethod
+    def loads(token, params):
+        try:
+            data = signing.loads(token, salt=Delta.SALT)
+        except signing.BadSignature:
+            raise app_exceptions.ApiError('InvalidWatermark', 'Watermark is invalid.')
+        if data.get('params') != params:
+            raise app_exceptions.ApiError('InvalidWatermark', 'Watermark was issued for other filter parameters.')
+        time = parse_datetime(data['time'])
+        if time < timezone.now() - Delta.TOMBSTONE_EXPIRE:
+            raise app_exceptions.ApiError('WatermarkExpired', 'Watermark is expired, a full export is required.',
+                                          status_code=410)
+        return time
+
+    @staticmethod
+    def get_oldest_transaction():
+        # 其他连接上仍未结束的最早的事务。它写入的refresh_time不早于其开始时间，但要到提交后才可见
+        # autovacuum等后台进程也会出现在pg_stat_activity中，它们不会写入记录，不能压低水位
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT min(xact_start) FROM pg_stat_activity '
+                           'WHERE datname = current_database() AND pid <> pg_backend_pid() AND xact_start IS NOT NULL '
+                           'AND backend_type = \'client backend\'')
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def prepare(queryset, params, token):
+        # 返回(需要导出的记录, manifest)。token为空时导出全部记录，并签发第一个水位
+        params = app_filters.RecordSummary.normalize(params)
+        since = Delta.loads(token, params) if token else None
+        # 水位不能超过仍在进行的事务的开始时间，否则这些事务提交的修改会被之后的增量导出永久遗漏
+        cap = Summary.transaction_time() - Delta.LAG
+        oldest = Delta.get_oldest_transaction()
+        if oldest is not None:
+            cap = min(cap, oldest - datetime.timedelta(microseconds=1))
+        if since is None:
+            changed = queryset
+            latest = app_models.RecordSummary.objects.aggregate(time=Max('refresh_time'))['time']
+            removed = []
+        else:
+            changed = queryset.filter(refresh_time__gt=since)
+            all_changed = app_models.RecordSummary.objects.filter(refresh_time__gt=since)
+            deleted = app_models.DeletedRecord.objects.filter(delete_time__gt=since)
+            latest = max([t for t in (since,
+                                      all_changed.aggregate(time=Max('refresh_time'))['time'],
+                                      deleted.aggregate(time=Max('delete_time'))['time']) if t is not None])
+            # 修改后不再符合筛选条件的记录，对于拉取方而言与删除相同
+            left = all_changed.exclude(award_record_id__in=changed.values('award_record_id'))
+            removed = sorted(set(deleted.values_list('award_record_id', flat=True)) |
+                             set(left.values_list('award_record_id', flat=True)))
+        watermark = min(latest, cap) if latest is not None else cap
+        if since is not None:
+            watermark = max(watermark, since)
+        manifest = {
+            'params': params,
+            'since': since.isoformat() if since is not None else None,
+            'until': watermark.isoformat(),
+            'watermark': Delta.dumps(watermark, params),
+            'records': changed.count(),
+            'removed': removed
+        }
+        return changed, manifest
+
+    @staticmethod
+    def clean_expired():
+        app_models.DeletedRecord.objects.filter(delete_time__lt=timezone.now() - Delta.TOMBSTONE_EXPIRE).delete()
+
+
+class ExportCache:
+    # 已生成的压缩包缓存在TEMP_DIRS/export-cache，以规范化的筛选参数与匹配记录的最大version、数量作为键。
+    # 记录的任何修改都会以更大的version重写RecordSummary，删除会改变数量，因此数据变化后键也随之变化，旧文件不再被命中
+    CACHE_DIRS = os.path.join(TEMP_DIRS, 'export-cache')
+    MAX_SIZE = 4 * 1024 * 1024 * 1024     # 缓存目录的总大小上限，超过时按最近使用时间淘汰
+
+    @staticmethod
+    def get_key(queryset, params):
+        stats = queryset.order_by().aggregate(count=Count('award_record_id'), max_version=Max('version'))
+        fingerprint = {
+            'params': app_filters.RecordSummary.normalize(params),
+            'ordering': [str(field) for field in queryset.query.order_by],
+            'count': stats['count'],
+            'max_version': stats['max_version']
+        }
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def get_path(key):
+        return os.path.join(ExportCache.CACHE_DIRS, '%s.zip' % (key,))
+
+    @staticmethod
+    def open(key):
+        # 命中时返回打开的文件，并更新修改时间作为最近使用时间。文件打开后即使被淘汰也可以继续读取
+        path = ExportCache.get_path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+        return f
+
+    @staticmethod
+    def iter_zip(queryset, key):
+        # 在输出的同时写入缓存。只有完整输出的压缩包才会进入缓存，客户端中途断开时丢弃临时文件
+        if not os.path.exists(ExportCache.CACHE_DIRS):
+            os.makedirs(ExportCache.CACHE_DIRS, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=ExportCache.CACHE_DIRS, prefix='.export-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in Download.iter_zip(queryset):
+                    f.write(chunk)
+                    yield chunk
+            os.replace(temp_path, ExportCache.get_path(key))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        ExportCache.evict()
+
+    @staticmethod
+    def evict():
+        entries = []
+        for name in os.listdir(ExportCache.CACHE_DIRS):
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(ExportCache.CACHE_DIRS, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, name) in sorted(entries):
+            if total <= ExportCache.MAX_SIZE:
+                break
+            try:
+                os.remove(os.path.join(ExportCache.CACHE_DIRS, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class Export:
+    EXPORT_DIRS = os.path.join(TEMP_DIRS, 'exports')
+    EXPIRE_TIME = datetime.timedelta(days=1)    # 导出结果的保留时间
+    STALE_TIME = datetime.timedelta(hours=6)    # 超过该时间仍为RUNNING的任务视为工作进程已中断
+    MAX_VOLUMES = 64
+    VOLUME_WORKERS = os.cpu_count() or 1        # 并行生成分卷的进程数
+
+    @staticmethod
+    def create_job(params, user, volumes=None, partition=None):
+        params = app_filters.RecordSummary.get_params(params)
+        # 提前校验参数，避免在后台任务中才失败
+        app_filters.RecordSummary.filter_records(app_models.RecordSummary.objects.none(), params)
+        try:
+            volumes = int(volumes) if volumes not in (None, '') else 1
+        except (TypeError, ValueError):
+            raise app_exceptions.ApiError('InvalidVolumes', 'Volumes must be an integer.')
+        if volumes < 1 or volumes > Export.MAX_VOLUMES:
+            raise app_exceptions.ApiError('InvalidVolumes', 'Volumes must be between 1 and %s.' % (Export.MAX_VOLUMES,))
+        if volumes == 1:
+            partition = None
+        else:
+            partition = partition.upper() if partition else enums.ExportPartition.id
+            if partition not in dict(enums.EXPORT_PARTITION):
+                raise app_exceptions.ApiError('InvalidPartition', 'Partition %s is not supported.' % (partition,))
+        job = app_models.ExportJob(params=params, volumes=volumes, partition=partition, create_user=user,
+                                   create_time=timezone.now())
+        job.save()
+        return job
+
+    @staticmethod
+    def get_path(job):
+        return os.path.join(Export.EXPORT_DIRS, job.file)
+
+    @staticmethod
+    def get_volume_path(job, index):
+        return os.path.join(Export.get_path(job), 'volume-%s.zip' % (index,))
+
+    @staticmethod
+    def get_manifest_path(job):
+        return os.path.join(Export.get_path(job), 'manifest.json')
+
+    @staticmethod
+    def get_queryset(params):
+        queryset = app_filters.RecordSummary.filter_records(app_models.RecordSummary.objects.all(), params)
+        return queryset.order_by('-update_time')
+
+    @staticmethod
+    def run_pending():
+        while True:
+            with transaction.atomic():
+                job = app_models.ExportJob.objects.select_for_update(skip_locked=True) \
+                    .filter(status=enums.ExportStatus.waiting).order_by('create_time').first()
+                if job is None:
+                    return
+                job.status = enums.ExportStatus.running
+                job.start_time = timezone.now()
+                job.save()
+            Export.run(job)
+
+    @staticmethod
+    def run(job):
+        try:
+            queryset = Export.get_queryset(job.params)
+            if not os.path.exists(Export.EXPORT_DIRS):
+                os.makedirs(Export.EXPORT_DIRS)
+            if job.volumes > 1:
+                job.file = Export.run_volumes(job, queryset)
+            else:
+                filename = '%s.zip' % (job.id,)
+                temp_path = os.path.join(Export.EXPORT_DIRS, '%s.part' % (filename,))
+                key = ExportCache.get_key(queryset, job.params)
+                with open(temp_path, 'wb') as f:
+                    cached = ExportCache.open(key)
+                    if cached is not None:
+                        with cached:
+                            shutil.copyfileobj(cached, f)
+                    else:
+                        for chunk in ExportCache.iter_zip(queryset, key):
+                            f.write(chunk)
+                os.replace(temp_path, os.path.join(Export.EXPORT_DIRS, filename))
+                job.file = filename
+            job.status = enums.ExportStatus.finished
+        except Exception as e:
+            job.status = enums.ExportStatus.failed
+            job.error = str(e)
+        job.finish_time = timezone.now()
+        job.save()
+
+    @staticmethod
+    def run_volumes(job, queryset):
+        # 各分卷在进程池中并行生成，完成后写出manifest.json，整个目录原子地rename
+        specs = Export.split(queryset, job.volumes, job.partition)
+        dirname = str(job.id)
+        temp_dir = os.path.join(Export.EXPORT_DIRS, '%s.part' % (dirname,))
+        os.makedirs(temp_dir, exist_ok=True)
+        try:
+            # 子进程必须建立自己的数据库连接，fork之前关闭当前进程的连接
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=min(len(specs), Export.VOLUME_WORKERS),
+                                     initializer=Export.init_worker) as pool:
+                futures = [pool.submit(Export.build_volume, job.params, spec, index, len(specs),
+                                       os.path.join(temp_dir, 'volume-%s.zip' % (index,)))
+                           for (index, spec) in enumerate(specs, 1)]
+                volumes = [future.result() for future in futures]
+            manifest = {
+                'job': dirname,
+                'params': job.params,
+                'partition': job.partition,
+                'records': sum(volume['records'] for volume in volumes),
+                'volumes': volumes
+            }
+            with open(os.path.join(temp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(temp_dir, os.path.join(Export.EXPORT_DIRS, dirname))
+        except BaseException:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        return dirname
+
+    @staticmethod
+    def split(queryset, volumes, partition):
+        # 返回各分卷的划分条件。按学院划分时，学院按记录数从多到少依次放入当前记录最少的分卷
+        if partition == enums.ExportPartition.college:
+            rows = queryset.annotate(college=KeyTextTransform('college', 'main_student_info')).order_by() \
+                .values('college').annotate(count=Count('award_record_id'))
+            bins = [{'colleges': [], 'records': 0} for _ in range(volumes)]
+            for row in sorted(rows, key=lambda r: (-r['count'], r['college'] or '')):
+                target = min(bins, key=lambda b: b['records'])
+                target['colleges'].append(row['college'])
+                target['records'] += row['count']
+            specs = [{'partition': partition, 'colleges': b['colleges']} for b in bins if len(b['colleges']) > 0]
+        else:
+            ids = list(queryset.order_by('award_record_id').values_list('award_record_id', flat=True))
+            size = max(1, -(-len(ids) // volumes))
+            specs = [{'partition': partition, 'min_id': ids[i], 'max_id': ids[min(i + size, len(ids)) - 1]}
+                     for i in range(0, len(ids), size)]
+        # 没有任何记录时仍然生成一个只有报表表头的分卷
+        return specs if len(specs) > 0 else [{'partition': partition}]
+
+    @staticmethod
+    def apply_partition(queryset, spec):
+        if 'colleges' in spec:
+            colleges = [college for college in spec['colleges'] if college is not None]
+            condition = Q(college__in=colleges)
+            if None in spec['colleges']:
+                condition |= Q(college__isnull=True)
+            queryset = queryset.annotate(college=KeyTextTransform('college', 'main_student_info')).filter(condition)
+        if 'min_id' in spec:
+            queryset = queryset.filter(award_record_id__gte=spec['min_id'], award_record_id__lte=spec['max_id'])
+        return queryset
+
+    @staticmethod
+    def init_worker():
+        if not apps.ready:
+            django.setup()
+
+    @staticmethod
+    def build_volume(params, spec, index, total, path):
+        # 在子进程中执行
+        queryset = Export.apply_partition(Export.get_queryset(params), spec)
+        records = queryset.count()
+        sha = hashlib.sha256()
+        with open(path, 'wb') as f:
+            for chunk in Download.iter_zip(queryset, {'volume': index, 'volumes': total, 'records': records, **spec}):
+                f.write(chunk)
+                sha.update(chunk)
+        return dict(spec, volume=index, file=os.path.basename(path), records=records, size=os.path.getsize(path),
+                    sha256=sha.hexdigest())
+
+    @staticmethod
+    def clean_expired():
+        expired = app_models.ExportJob.objects.filter(finish_time__lt=timezone.now() - Export.EXPIRE_TIME)
+        for job in expired:
+            if job.file is not None and os.path.isdir(Export.get_path(job)):
+                shutil.rmtree(Export.get_path(job))
+            elif job.file is not None and os.path.exists(Export.get_path(job)):
+                os.remove(Export.get_path(job))
+        expired.delete()
+
+    @staticmethod
+    def recover_stale():
+        # 工作进程中断时任务会一直停留在RUNNING：超时的任务标记为失败，并删除不属于任何运行中任务的临时文件
+        now = timezone.now()
+        app_models.ExportJob.objects.filter(status=enums.ExportStatus.running) \
+            .filter(Q(start_time__lt=now - Export.STALE_TIME) | Q(start_time__isnull=True)) \
+            .update(status=enums.ExportStatus.failed, error='Export worker stopped unexpectedly.', finish_time=now)
+        if not os.path.exists(Export.EXPORT_DIRS):
+            return
+        running = {str(job_id) for job_id in app_models.ExportJob.objects.filter(status=enums.ExportStatus.running)
+                   .values_list('id', flat=True)}
+        for name in os.listdir(Export.EXPORT_DIRS):
+            if not name.endswith('.part') or name.split('.', 1)[0] in running:
+                continue
+            path = os.path.join(Export.EXPORT_DIRS, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,99 @@
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, pre_delete, post_delete
+from . import models as app_models, services, cache as app_cache
+
+# 记录本身的写入路径会显式刷新RecordSummary。这里处理的是被记录冗余引用的参考数据的修改
+
+
+def reference_changed(sender, **kwargs):
+    app_cache.ReferenceCache.invalidate()
+
+
+def table_changed(sender, **kwargs):
+    # student接口的ETag与响应缓存以这些版本号为准
+    app_cache.Version.bump(sender._meta.model_name)
+
+
+def student_saved(sender, instance, created, **kwargs):
+    if not created:
+        services.Summary.refresh_students([instance.id])
+
+
+def teacher_saved(sender, instance, created, **kwargs):
+    if not created:
+        services.Summary.refresh_teachers([instance.id])
+
+
+def class_saved(sender, instance, created, **kwargs):
+    if not created:
+        services.Summary.refresh_students(app_models.Student.objects.filter(clazz=instance).values('id'))
+
+
+def subject_saved(sender, instance, created, **kwargs):
+    if not created:
+        services.Summary.refresh_students(app_models.Student.objects.filter(clazz__subject=instance).values('id'))
+
+
+def college_saved(sender, instance, created, **kwargs):
+    if not created:
+        services.Summary.refresh_students(app_models.Student.objects.filter(clazz__subject__college=instance)
+                                          .values('id'))
+
+
+def competition_saved(sender, instance, created, **kwargs):
+    if not created:
+        services.Summary.refresh_competitions([instance.name])
+
+
+def rating_info_saved(sender, instance, created, **kwargs):
+    if not created:
+        services.Summary.refresh_competitions(app_models.Competition.objects.filter(rating_info=instance)
+                                              .values('name'))
+
+
+# 删除参考数据时，Django对引用它的记录执行SET_NULL或级联删除，不会触发记录本身的写入路径。
+# 在删除前取出受影响的记录编号，事务提交后再刷新
+DELETED_RECORDS = {
+    app_models.Student: lambda instance: Q(main_student=instance) | Q(students=instance),
+    app_models.Teacher: lambda instance: Q(teacher=instance),
+    app_models.Class: lambda instance: Q(main_student__clazz=instance) | Q(students__clazz=instance),
+    app_models.Subject: lambda instance: Q(main_student__clazz__subject=instance) | Q(students__clazz__subject=instance),
+    app_models.College: lambda instance: Q(main_student__clazz__subject__college=instance) |
+                                         Q(students__clazz__subject__college=instance),
+    app_models.Competition: lambda instance: Q(competition_record__competition=instance),
+    app_models.RatingInfo: lambda instance: Q(competition_record__competition__rating_info=instance)
+}
+
+
+def reference_deleting(sender, instance, **kwargs):
+    record_ids = list(app_models.AwardRecord.objects.filter(DELETED_RECORDS[sender](instance))
+                      .values_list('id', flat=True).distinct())
+    if len(record_ids) > 0:
+        transaction.on_commit(lambda: services.Summary.refresh(record_ids))
+
+
+def record_deleted(sender, instance, **kwargs):
+    # 增量导出需要列出被删除的记录
+    app_models.DeletedRecord.objects.create(award_record_id=instance.id,
+                                            delete_time=services.Summary.transaction_time())
+
+
+def connect():
+    # 缓存失效必须先于下面刷新RecordSummary的接收者执行
+    for model in (app_models.RatingInfo, app_models.Competition):
+        post_save.connect(reference_changed, sender=model)
+        post_delete.connect(reference_changed, sender=model)
+    for model in (app_models.College, app_models.Subject, app_models.Class, app_models.Student, app_models.Teacher):
+        post_save.connect(table_changed, sender=model)
+        post_delete.connect(table_changed, sender=model)
+    post_save.connect(student_saved, sender=app_models.Student)
+    post_save.connect(teacher_saved, sender=app_models.Teacher)
+    post_save.connect(class_saved, sender=app_models.Class)
+    post_save.connect(subject_saved, sender=app_models.Subject)
+    post_save.connect(college_saved, sender=app_models.College)
+    post_save.connect(competition_saved, sender=app_models.Competition)
+    post_save.connect(rating_info_saved, sender=app_models.RatingInfo)
+    for model in DELETED_RECORDS.keys():
+        pre_delete.connect(reference_deleting, sender=model)
+    post_delete.connect(record_deleted, sender=app_models.AwardRecord)
@@ -1,3 +1,774 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, migrations, transaction
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from PIL import Image as PILImage
+from rest_framework import status
+from rest_framework.test import APIClient
+from unittest import mock
+from . import models as app_models, cache as app_cache, enums, services, recognition
+import datetime
+import importlib
+import io
+import json
+import os
+import tempfile
+import threading
+import zipfile
 
-# Create your tests here.
+
+def create_student(card_id, name, clazz, with_user=False):
+    user = None
+    if with_user:
+        user = User.objects.create_user(username='%s:%s' % (enums.UserType.student, card_id), first_name=name)
+    return app_models.Student.objects.create(card_id=card_id, name=name, clazz=clazz, user=user)
+
+
+def create_record(user, competition_name, update_time=None, review_status=enums.ReviewStatus.waiting,
+                  main_student=None):
+    record = app_models.AwardRecord.objects.create(works_name='works', award_level='一等奖', submit_user=user,
+                                                   update_time=update_time or timezone.now(), main_student=main_student)
+    app_models.CompetitionRecord.objects.create(name=competition_name, category='程序设计', organizer='组委会',
+                                                hold_time=datetime.date(2019, 5, 1), award_record=record)
+    app_models.Review.objects.create(status=review_status, award_record=record)
+    services.Summary.refresh([record.id])
+    return record
+
+
+class EarlyTransaction(threading.Thread):
+    # 在另一个连接上先开始事务，退出with时才执行写入并提交，模拟先开始、后提交的长事务
+    def __init__(self, func):
+        super().__init__()
+        self.func = func
+        self.error = None
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+
+    def run(self):
+        try:
+            with transaction.atomic():
+                services.Summary.transaction_time()
+                self.started.set()
+                self.proceed.wait()
+                self.func()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.started.set()
+            connection.close()
+
+    def __enter__(self):
+        self.start()
+        self.started.wait()
+        return self
+
+    def __exit__(self, *args):
+        self.proceed.set()
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+class ApiTestMixin:
+    def setUp(self):
+        # 响应缓存与参考数据缓存都在进程内，不随测试的数据库回滚而清除
+        cache.clear()
+        app_cache.ReferenceCache.invalidate()
+        college = app_models.College.objects.create(name='计算机学院')
+        subject = app_models.Subject.objects.create(name='软件工程', college=college)
+        self.clazz = app_models.Class.objects.create(grade=2017, number=1, subject=subject)
+        self.student = create_student('2017001', '张三', self.clazz, with_user=True)
+        self.admin = User.objects.create_user(username='%s:%s' % (enums.UserType.admin, 'tester'),
+                                              is_staff=True, first_name='Tester')
+        self.client = APIClient()
+
+    def assertNotModified(self, url, **headers):
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=res['ETag'], **headers)
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        return res['ETag']
+
+
+def create_jpeg(color=(200, 180, 160), size=(64, 48)):
+    buffer = io.BytesIO()
+    PILImage.new('RGB', size, color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class ImageFileMixin:
+    # 图片、缩略图与导出缓存写入临时目录
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.image_dirs = os.path.join(temp_dir.name, 'image')
+        for (target, value) in (('api.services.IMAGE_DIRS', self.image_dirs),
+                                ('api.images.IMAGE_DIRS', self.image_dirs),
+                                ('api.images.Derivative.DERIVATIVE_DIRS', os.path.join(self.image_dirs, 'derivatives')),
+                                ('api.services.ExportCache.CACHE_DIRS', os.path.join(temp_dir.name, 'export-cache'))):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def upload_image(self, record, filename, content, category=enums.ImageCategory.award):
+        self.client.force_authenticate(record.submit_user)
+        res = self.client.post(reverse('api-student-image-list'), {
+            'award_record': record.id, 'category': category, 'file': SimpleUploadedFile(filename, content)
+        }, format='multipart')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        return res.data['file']
+
+
+class BatchReviewTest(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.admin)
+        app_models.RatingInfo.objects.create(competition_name='蓝桥杯', category='A', level_title='国家级',
+                                             level=1)
+        app_models.Competition.objects.create(name='ACM-ICPC 2019', category='程序设计', organizer='ICPC',
+                                              hold_time=datetime.date(2019, 10, 1))
+
+    def review(self, data):
+        res = self.client.post(reverse('api-admin-record-review'), data, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return {item['id']: item for item in res.data}
+
+    def test_outcomes(self):
+        user = self.student.user
+        new_first = create_record(user, '第十届蓝桥杯')
+        new_second = create_record(user, '第十届蓝桥杯')
+        no_rating = create_record(user, '未知竞赛')
+        existing = create_record(user, '未知竞赛')
+        unknown = create_record(user, '未知竞赛')
+        rejected = create_record(user, '未知竞赛')
+        results = self.review([
+            {'id': new_first.id, 'review_status': enums.ReviewStatus.passed, 'rating_info': '蓝桥杯'},
+            {'id': new_second.id, 'review_status': enums.ReviewStatus.passed},
+            {'id': no_rating.id, 'review_status': enums.ReviewStatus.passed},
+            {'id': existing.id, 'review_status': enums.ReviewStatus.passed, 'competition': 'ACM-ICPC 2019'},
+            {'id': unknown.id, 'review_status': enums.ReviewStatus.passed, 'competition': '不存在的竞赛'},
+            {'id': rejected.id, 'review_status': enums.ReviewStatus.not_pass},
+            {'id': 0, 'review_status': enums.ReviewStatus.passed}
+        ])
+
+        # 同一批中第一条创建的竞赛可以被后面的记录直接使用
+        self.assertTrue(results[new_first.id]['success'])
+        self.assertTrue(results[new_second.id]['success'])
+        competition = app_models.Competition.objects.get(name='第十届蓝桥杯')
+        self.assertEqual(competition.rating_info_id, '蓝桥杯')
+        competition_record = app_models.CompetitionRecord.objects.get(award_record=new_second)
+        self.assertEqual(competition_record.competition_id, '第十届蓝桥杯')
+
+        self.assertEqual(results[no_rating.id]['code'], 'RatingInfoRequired')
+        self.assertEqual(results[unknown.id]['code'], 'CompetitionNotFound')
+        self.assertEqual(results[0]['code'], 'NotFound')
+
+        # 指定已有竞赛时以竞赛的信息覆盖记录中的竞赛信息
+        self.assertEqual(results[existing.id]['competition'], 'ACM-ICPC 2019')
+        competition_record = app_models.CompetitionRecord.objects.get(award_record=existing)
+        self.assertEqual((competition_record.name, competition_record.organizer), ('ACM-ICPC 2019', 'ICPC'))
+
+        self.assertTrue(results[rejected.id]['success'])
+        statuses = dict(app_models.Review.objects.values_list('award_record_id', 'status'))
+        self.assertEqual(statuses[new_first.id], enums.ReviewStatus.passed)
+        self.assertEqual(statuses[existing.id], enums.ReviewStatus.passed)
+        self.assertEqual(statuses[rejected.id], enums.ReviewStatus.not_pass)
+        self.assertEqual(statuses[no_rating.id], enums.ReviewStatus.waiting)
+        self.assertEqual(statuses[unknown.id], enums.ReviewStatus.waiting)
+
+        # 汇总表随审核刷新
+        summary = app_models.RecordSummary.objects.get(award_record=new_second)
+        self.assertEqual((summary.review_status, summary.rating_category, summary.rating_level_title),
+                         (enums.ReviewStatus.passed, 'A', '国家级'))
+
+    def test_invalid_body(self):
+        res = self.client.post(reverse('api-admin-record-review'), [{'id': 1, 'review_status': 'UNKNOWN'}],
+                               format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_staff_only(self):
+        self.client.force_authenticate(self.student.user)
+        res = self.client.post(reverse('api-admin-record-review'), [], format='json')
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class StudentImportTest(ApiTestMixin, TransactionTestCase):
+    # 导入使用ON COMMIT DROP的临时表，必须在真实的事务中运行
+    HEADER = '学号,姓名,年级,班级,专业,学院\n'
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.admin)
+
+    def upload(self, content, name='students.csv'):
+        res = self.client.post(reverse('api-admin-student-import-list'),
+                               {'file': SimpleUploadedFile(name, content)}, format='multipart')
+        return res
+
+    def test_counts(self):
+        content = self.HEADER + '2017001,张三,2017,1,软件工程,计算机学院\n' \
+                                '2017002,李四,2017,2,软件工程,计算机学院\n' \
+                                '2017003,,2017,2,软件工程,计算机学院\n'
+        res = self.upload(content.encode())
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        # 2017001已存在且没有变化，不计入修改
+        self.assertEqual((res.data['total'], res.data['created'], res.data['updated'], res.data['error_count']),
+                         (3, 1, 0, 1))
+        self.assertEqual(res.data['errors'][0]['row'], 4)
+        self.assertEqual(app_models.Student.objects.get(card_id='2017002').clazz.number, 2)
+
+        res = self.upload(content.encode())
+        self.assertEqual((res.data['created'], res.data['updated']), (0, 0))
+
+    def test_update_refreshes_summary(self):
+        record = create_record(self.student.user, '第十届蓝桥杯', main_student=self.student)
+        res = self.upload((self.HEADER + '2017001,张小三,2017,1,软件工程,计算机学院\n').encode())
+        self.assertEqual((res.data['created'], res.data['updated']), (0, 1))
+        self.assertEqual(app_models.RecordSummary.objects.get(award_record=record).main_student_name, '张小三')
+
+    def test_gbk(self):
+        res = self.upload((self.HEADER + '2017004,王五,2018,1,网络工程,计算机学院\n').encode('gbk'))
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['created'], 1)
+        student = app_models.Student.objects.get(card_id='2017004')
+        self.assertEqual((student.name, student.clazz.subject.name), ('王五', '网络工程'))
+
+    def test_invalid_numbers(self):
+        content = self.HEADER + '2017002,李四,1e400,1,软件工程,计算机学院\n' \
+                                '2017003,王五,20170010001,1,软件工程,计算机学院\n' \
+                                '2017004,赵六,2017,0,软件工程,计算机学院\n' \
+                                '2017005,钱七,2017.0,2,软件工程,计算机学院\n'
+        res = self.upload(content.encode())
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((res.data['created'], res.data['error_count']), (1, 3))
+        errors = {error['row']: error['detail'] for error in res.data['errors']}
+        self.assertEqual(errors[2], {'clazz_grade': 'A valid integer is required.'})
+        self.assertIn('clazz_grade', errors[3])
+        self.assertIn('clazz_number', errors[4])
+        self.assertEqual(app_models.Student.objects.get(card_id='2017005').clazz.grade, 2017)
+
+    def test_invalid_file(self):
+        self.assertEqual(self.upload(b'', name='students.txt').status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.upload(self.HEADER.replace('学号', 'id').encode())
+        self.assertEqual(res.data['code'], 'InvalidHeader')
+
+
+class KeysetPaginationTest(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        user = self.student.user
+        # 两条记录的修改时间相同，由pk区分先后
+        self.records = [create_record(user, '竞赛%s' % (i,), update_time=now - datetime.timedelta(minutes=i // 2))
+                        for i in range(7)]
+        self.expected = [record.id for record in
+                         sorted(self.records, key=lambda r: (r.update_time, r.id), reverse=True)]
+
+    def collect(self, url):
+        ids, pages = [], 0
+        url = '%s?cursor=&limit=2' % (url,)
+        while url is not None:
+            res = self.client.get(url)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', res.data)
+            ids += [item['id'] for item in res.data['results']]
+            url = res.data['next']
+            pages += 1
+        self.assertEqual(pages, 4)
+        return ids
+
+    def test_student_records(self):
+        self.client.force_authenticate(self.student.user)
+        self.assertEqual(self.collect(reverse('api-student-record-list')), self.expected)
+
+    def test_admin_records(self):
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(self.collect(reverse('api-admin-record-list')), self.expected)
+
+    def test_new_records_do_not_shift_pages(self):
+        self.client.force_authenticate(self.admin)
+        res = self.client.get('%s?cursor=&limit=3' % (reverse('api-admin-record-list'),))
+        create_record(self.student.user, '新竞赛')
+        res = self.client.get(res.data['next'])
+        self.assertEqual([item['id'] for item in res.data['results']], self.expected[3:6])
+
+    def test_offset_by_default(self):
+        self.client.force_authenticate(self.admin)
+        res = self.client.get('%s?limit=2' % (reverse('api-admin-record-list'),))
+        self.assertEqual(res.data['count'], 7)
+
+    def test_invalid_cursor(self):
+        self.client.force_authenticate(self.admin)
+        res = self.client.get('%s?cursor=invalid' % (reverse('api-admin-record-list'),))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RecordSearchTest(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = self.student.user
+        self.first = create_record(user, '数学建模竞赛', main_student=self.student)
+        self.second = create_record(user, 'ACM程序设计竞赛',
+                                    main_student=create_student('2017002', '张三丰', self.clazz))
+        self.client.force_authenticate(self.admin)
+
+    def search(self, search):
+        res = self.client.get(reverse('api-admin-record-list'), {'search': search, 'limit': 10})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return sorted(item['id'] for item in res.data['results'])
+
+    def test_short_terms(self):
+        # 一到两个字的搜索词产生不了三元组，由search_grams匹配
+        self.assertEqual(self.search('张三'), [self.first.id, self.second.id])
+        self.assertEqual(self.search('三丰'), [self.second.id])
+        self.assertEqual(self.search('张'), [self.first.id, self.second.id])
+        self.assertEqual(self.search('张四'), [])
+
+    def test_long_terms(self):
+        self.assertEqual(self.search('学建模'), [self.first.id])
+        self.assertEqual(self.search('acm'), [self.second.id])
+        self.assertEqual(self.search('建模 张三'), [self.first.id])
+        self.assertEqual(self.search('建模设计'), [])
+
+    def test_terms_do_not_span_fields(self):
+        # 各字段逐行拼接，相邻两字不跨越行
+        self.assertEqual(self.search('赛张'), [])
+
+    def test_migration_backfill(self):
+        # 迁移中回填的search_grams与Summary.build的结果相同，rebuild_record_summary不会报告不一致
+        migration = importlib.import_module('api.migrations.0016_recordsummary_search_grams').Migration
+        (backfill,) = [op for op in migration.operations if isinstance(op, migrations.RunSQL)]
+        app_models.RecordSummary.objects.update(search_grams=[])
+        with connection.cursor() as cursor:
+            cursor.execute(backfill.sql)
+        self.assertIn('张三', app_models.RecordSummary.objects.get(award_record_id=self.first.id).search_grams)
+        self.assertEqual(services.Summary.rebuild(check=True), ([], [], []))
+
+
+class VersionCacheTest(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.student.user)
+        app_models.Teacher.objects.create(card_id='T001', name='赵老师')
+
+    def test_reference_data(self):
+        url = reverse('api-student-class-list')
+        etag = self.assertNotModified(url)
+        self.clazz.number = 3
+        self.clazz.save()
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res['ETag'], etag)
+        self.assertEqual(res.data[0]['number'], 3)
+
+        self.assertNotModified(reverse('api-student-student-detail', args=('2017001',)))
+        self.assertNotModified(reverse('api-student-teacher-list'))
+
+
+class ConditionalRequestTest(ApiTestMixin, TransactionTestCase):
+    # 汇总表的refresh_time取事务开始的时间，需要每次写入各自提交
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.student.user)
+
+    def test_record_list(self):
+        url = reverse('api-student-record-list')
+        record = create_record(self.student.user, '第十届蓝桥杯')
+        etag = self.assertNotModified(url)
+
+        # 审核只修改Review，经由汇总表的refresh_time使ETag变化
+        app_models.Review.objects.filter(award_record=record).update(status=enums.ReviewStatus.passed)
+        services.Summary.refresh([record.id])
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        etag = res['ETag']
+
+        record.delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_record_list_late_commit(self):
+        url = reverse('api-student-record-list')
+        first = create_record(self.student.user, '第十届蓝桥杯')
+        second = create_record(self.student.user, '第十届蓝桥杯')
+
+        def review():
+            app_models.Review.objects.filter(award_record=second).update(status=enums.ReviewStatus.passed)
+            services.Summary.refresh([second.id])
+        with EarlyTransaction(review):
+            app_models.AwardRecord.objects.filter(id=first.id).update(works_name='changed')
+            services.Summary.refresh([first.id])
+            etag = self.assertNotModified(url)
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        statuses = {item['id']: item['review_status'] for item in res.data}
+        self.assertEqual(statuses[second.id], enums.ReviewStatus.passed)
+
+    def test_record_detail(self):
+        record = create_record(self.student.user, '第十届蓝桥杯',
+                               update_time=timezone.now() - datetime.timedelta(hours=1))
+        url = reverse('api-student-record-detail', args=(record.id,))
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        last_modified = res['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        earlier = http_date((timezone.now() - datetime.timedelta(days=1)).timestamp())
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=earlier).status_code, status.HTTP_200_OK)
+
+    def test_records_are_per_user(self):
+        other = create_student('2017002', '李四', self.clazz, with_user=True)
+        create_record(other.user, '第十届蓝桥杯')
+        url = reverse('api-student-record-detail', args=(app_models.AwardRecord.objects.get().id,))
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ExportCacheTest(ApiTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        user = self.student.user
+        self.first = create_record(user, '第十届蓝桥杯')
+        self.second = create_record(user, '第十届蓝桥杯')
+
+    @staticmethod
+    def get_key():
+        return services.ExportCache.get_key(app_models.RecordSummary.objects.all(), {})
+
+    def test_delete(self):
+        key = self.get_key()
+        self.assertEqual(self.get_key(), key)
+        app_models.AwardRecord.objects.filter(id=self.first.id).delete()
+        self.assertNotEqual(self.get_key(), key)
+
+    def test_late_commit(self):
+        # 审核先开始、后提交，它的refresh_time早于另一条记录的修改，最大时间与数量都不会变化
+        def review():
+            app_models.Review.objects.filter(award_record=self.second).update(status=enums.ReviewStatus.passed)
+            services.Summary.refresh([self.second.id])
+        with EarlyTransaction(review):
+            app_models.AwardRecord.objects.filter(id=self.first.id).update(works_name='changed')
+            services.Summary.refresh([self.first.id])
+            key = self.get_key()
+        summary = app_models.RecordSummary.objects.get(award_record=self.second)
+        self.assertEqual(summary.review_status, enums.ReviewStatus.passed)
+        self.assertNotEqual(self.get_key(), key)
+
+
+class ImageUploadTest(ImageFileMixin, ApiTestMixin, TestCase):
+    def test_same_content_shares_file(self):
+        content = create_jpeg()
+        first = self.upload_image(create_record(self.student.user, '第十届蓝桥杯'), 'a.JPG', content)
+        second = self.upload_image(create_record(self.student.user, '第十届蓝桥杯'), 'b.jpg', content)
+        self.assertEqual(first, second)
+        self.assertEqual(os.path.splitext(first)[1], '.jpg')
+        with open(os.path.join(self.image_dirs, first), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual([name for name in os.listdir(self.image_dirs) if not name.startswith('.')].count(first), 1)
+
+    def test_export_without_extension(self):
+        record = create_record(self.student.user, '第十届蓝桥杯')
+        content = create_jpeg()
+        name = self.upload_image(record, 'photo', content)
+        self.assertNotIn('.', name)
+
+        self.client.force_authenticate(self.admin)
+        res = self.client.get(reverse('api-admin-record-download'))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        with zipfile.ZipFile(io.BytesIO(b''.join(res.streaming_content))) as archive:
+            self.assertEqual(archive.read('%s-获奖证书' % (record.id,)), content)
+
+
+class DeliveryTest(ImageFileMixin, ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = create_jpeg(size=(400, 300))
+        self.record = create_record(self.student.user, '第十届蓝桥杯')
+        self.name = self.upload_image(self.record, 'award.jpg', self.content)
+        self.url = reverse('api-file-image-detail', args=(self.name,))
+        self.size = len(self.content)
+
+    def get(self, **headers):
+        res = self.client.get(self.url, **headers)
+        body = b''.join(res.streaming_content) if res.streaming else res.content
+        return res, body
+
+    def test_parse_range(self):
+        self.assertIsNone(services.Delivery.parse_range(None, 100))
+        self.assertIsNone(services.Delivery.parse_range('items=0-1', 100))
+        self.assertIsNone(services.Delivery.parse_range('bytes=0-1,5-6', 100))
+        self.assertEqual(services.Delivery.parse_range('bytes=10-19', 100), (10, 19))
+        self.assertEqual(services.Delivery.parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(services.Delivery.parse_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(services.Delivery.parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(services.Delivery.parse_range('bytes=-200', 100), (0, 99))
+        for header in ('bytes=100-', 'bytes=20-10', 'bytes=-0', 'bytes=-', 'bytes=a-b'):
+            self.assertRaises(ValueError, services.Delivery.parse_range, header, 100)
+
+    def test_permission(self):
+        res, body = self.get()
+        self.assertEqual((res.status_code, body), (status.HTTP_200_OK, self.content))
+        self.assertEqual(res['Content-Type'], 'image/jpeg')
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(self.get()[0].status_code, status.HTTP_200_OK)
+        self.client.force_authenticate(create_student('2017002', '李四', self.clazz, with_user=True).user)
+        self.assertEqual(self.get()[0].status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.get()[0].status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_range(self):
+        res, body = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual((res.status_code, body), (status.HTTP_206_PARTIAL_CONTENT, self.content[10:20]))
+        self.assertEqual(res['Content-Range'], 'bytes 10-19/%s' % (self.size,))
+        self.assertEqual(res['Content-Length'], '10')
+        res, body = self.get(HTTP_RANGE='bytes=-5')
+        self.assertEqual(body, self.content[-5:])
+        res, body = self.get(HTTP_RANGE='bytes=0-1,5-6')
+        self.assertEqual((res.status_code, body), (status.HTTP_200_OK, self.content))
+        self.assertEqual(res['Accept-Ranges'], 'bytes')
+
+        res, body = self.get(HTTP_RANGE='bytes=%s-' % (self.size,))
+        self.assertEqual(res.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(res['Content-Range'], 'bytes */%s' % (self.size,))
+
+    def test_if_range(self):
+        etag = self.get()[0]['ETag']
+        res, body = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual((res.status_code, body), (status.HTTP_206_PARTIAL_CONTENT, self.content[:10]))
+        # 客户端持有的版本已经过期时返回完整的文件
+        res, body = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual((res.status_code, body), (status.HTTP_200_OK, self.content))
+
+    def test_not_modified(self):
+        res, _ = self.get()
+        self.assertIn('immutable', res['Cache-Control'])
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=res['ETag'])[0].status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=res['Last-Modified'])[0].status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+        # If-None-Match优先于If-Modified-Since
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"', HTTP_IF_MODIFIED_SINCE=res['Last-Modified'])[0]
+                         .status_code, status.HTTP_200_OK)
+
+    def test_sendfile(self):
+        with mock.patch('api.services.IMAGE_SENDFILE', 'nginx'):
+            res, body = self.get()
+            self.assertEqual((res.status_code, body), (status.HTTP_200_OK, b''))
+            self.assertEqual(res['X-Accel-Redirect'], services.IMAGE_INTERNAL_URL + self.name)
+        with mock.patch('api.services.IMAGE_SENDFILE', 'apache'):
+            res, body = self.get()
+            self.assertEqual(res['X-Sendfile'], os.path.join(self.image_dirs, self.name))
+            self.assertEqual(body, b'')
+
+    def test_variant(self):
+        res, body = self.get(QUERY_STRING='variant=thumbnail')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        with PILImage.open(io.BytesIO(body)) as image:
+            self.assertLess(image.size[0], 400)
+        self.assertEqual(self.client.get(self.url, {'variant': 'unknown'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DeltaTest(ApiTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        # 每次写入各自提交，时间先后即可区分，不需要额外的余量
+        patcher = mock.patch('api.services.Delta.LAG', datetime.timedelta(0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_authenticate(self.admin)
+        self.records = [create_record(self.student.user, '第十届蓝桥杯') for _ in range(4)]
+
+    def download(self, watermark, **params):
+        res = self.client.get(reverse('api-admin-record-download'), dict(params, watermark=watermark))
+        if res.status_code != status.HTTP_200_OK:
+            return res, None
+        with zipfile.ZipFile(io.BytesIO(b''.join(res.streaming_content))) as archive:
+            manifest = json.loads(archive.read('manifest.json').decode())
+        self.assertEqual(res['X-Export-Watermark'], manifest['watermark'])
+        return res, manifest
+
+    def test_changes(self):
+        _, manifest = self.download('', review__status='waiting')
+        self.assertEqual((manifest['since'], manifest['records'], manifest['removed']), (None, 4, []))
+
+        changed, deleted, left, _ = [record.id for record in self.records]
+        app_models.AwardRecord.objects.filter(id=changed).update(works_name='changed')
+        services.Summary.refresh([changed])
+        app_models.AwardRecord.objects.get(id=deleted).delete()
+        # 审核通过后不再符合筛选条件，对于拉取方而言与删除相同
+        app_models.Review.objects.filter(award_record_id=left).update(status=enums.ReviewStatus.passed)
+        services.Summary.refresh([left])
+        _, manifest = self.download(manifest['watermark'], review__status='waiting')
+        self.assertEqual((manifest['records'], manifest['removed']), (1, sorted([deleted, left])))
+
+        _, manifest = self.download(manifest['watermark'], review__status='waiting')
+        self.assertEqual((manifest['records'], manifest['removed']), (0, []))
+
+    def test_invalid_watermark(self):
+        res, _ = self.download('invalid')
+        self.assertEqual((res.status_code, res.data['code']), (status.HTTP_400_BAD_REQUEST, 'InvalidWatermark'))
+        _, manifest = self.download('', review__status='waiting')
+        res, _ = self.download(manifest['watermark'])
+        self.assertEqual((res.status_code, res.data['code']), (status.HTTP_400_BAD_REQUEST, 'InvalidWatermark'))
+        expired = services.Delta.dumps(timezone.now() - services.Delta.TOMBSTONE_EXPIRE - datetime.timedelta(days=1),
+                                       {})
+        res, _ = self.download(expired)
+        self.assertEqual((res.status_code, res.data['code']), (status.HTTP_410_GONE, 'WatermarkExpired'))
+
+    def test_open_transaction(self):
+        # 先开始、后提交的事务写入的refresh_time早于之后提交的修改，水位不能越过它的开始时间
+        queryset = app_models.RecordSummary.objects.all()
+        _, manifest = services.Delta.prepare(queryset, {}, '')
+        first, second = [record.id for record in self.records[:2]]
+
+        def review():
+            app_models.Review.objects.filter(award_record_id=second).update(status=enums.ReviewStatus.passed)
+            services.Summary.refresh([second])
+        with EarlyTransaction(review):
+            app_models.AwardRecord.objects.filter(id=first).update(works_name='changed')
+            services.Summary.refresh([first])
+            changed, manifest = services.Delta.prepare(queryset, {}, manifest['watermark'])
+            self.assertEqual(list(changed.values_list('award_record_id', flat=True)), [first])
+        changed, manifest = services.Delta.prepare(queryset, {}, manifest['watermark'])
+        self.assertIn(second, changed.values_list('award_record_id', flat=True))
+
+
+class WordsBackend:
+    # 返回固定文字的识别后端
+    name = 'words'
+    version = 'words-1'
+
+    def __init__(self, words):
+        self.words = words
+
+    def recognize(self, path):
+        return {'words': self.words}
+
+
+class FailingBackend:
+    name = 'failing'
+    version = 'failing-1'
+
+    def recognize(self, path):
+        raise RuntimeError('quota exceeded')
+
+
+class RecognitionWorkerTest(ImageFileMixin, ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        content = create_jpeg(size=(400, 300))
+        self.records = [create_record(self.student.user, '第十届蓝桥杯') for _ in range(2)]
+        # 两条记录上传了内容相同的图片，另一张图片内容不同
+        self.shared = [self.upload_image(record, 'award.jpg', content) for record in self.records]
+        self.other = self.upload_image(self.records[0], 'notice.jpg', create_jpeg(color=(10, 20, 30)),
+                                       category=enums.ImageCategory.notice)
+
+    @staticmethod
+    def run_worker(backend):
+        return recognition.Worker(backend, workers=2, batch_size=2).run_pending()
+
+    def test_stub(self):
+        self.assertEqual(self.run_worker(recognition.StubBackend()), 3)
+        # 相同内容只识别一次
+        self.assertEqual(app_models.Recognition.objects.count(), 2)
+        shared = app_models.Recognition.objects.get(digest=self.shared[0].split('.')[0])
+        self.assertEqual((shared.status, shared.version), (enums.RecognitionStatus.finished, 'stub-1'))
+        self.assertGreater(shared.field_model['width'], 0)
+        self.assertEqual(app_models.Image.objects.filter(recognition=shared).count(), 2)
+        self.assertFalse(app_models.Image.objects.filter(recognition__isnull=True).exists())
+        self.assertEqual(self.run_worker(recognition.StubBackend()), 0)
+
+    def test_backend_change(self):
+        app_models.Competition.objects.create(name='第十届蓝桥杯', category='程序设计', organizer='组委会',
+                                              hold_time=datetime.date(2019, 5, 1))
+        self.run_worker(recognition.StubBackend())
+        # 更换后端后已有的结果重新识别，并从文字中提取奖项与竞赛
+        self.assertEqual(self.run_worker(WordsBackend(['第十届蓝桥杯', '荣获一等奖'])), 3)
+        self.assertEqual(app_models.Recognition.objects.count(), 2)
+        for item in app_models.Recognition.objects.all():
+            self.assertEqual(item.version, 'words-1')
+            self.assertEqual(item.mapping_model, {'award_level': '一等奖', 'competition_name': '第十届蓝桥杯'})
+            self.assertEqual(item.competition_id, '第十届蓝桥杯')
+
+    def test_failure_and_retry(self):
+        with self.assertLogs('api.recognition', 'WARNING'):
+            self.assertEqual(self.run_worker(FailingBackend()), 3)
+        failed = app_models.Recognition.objects.filter(status=enums.RecognitionStatus.failed)
+        self.assertEqual(failed.count(), 2)
+        self.assertEqual(failed.first().error, 'quota exceeded')
+        # 同一后端的失败结果不会自动重试
+        self.assertEqual(self.run_worker(FailingBackend()), 0)
+
+        self.assertEqual(recognition.Worker.reset(retry_failed=True), 2)
+        self.assertEqual(app_models.Image.objects.filter(recognition__isnull=True).count(), 3)
+        self.assertEqual(self.run_worker(recognition.StubBackend()), 3)
+        self.assertEqual(app_models.Recognition.objects.filter(status=enums.RecognitionStatus.finished).count(), 2)
+
+    def test_replaced_image(self):
+        self.run_worker(recognition.StubBackend())
+        # 替换图片后解除旧的识别结果，新内容重新识别
+        name = self.upload_image(self.records[1], 'new.jpg', create_jpeg(color=(90, 90, 90)))
+        image = app_models.Image.objects.get(file=name)
+        self.assertIsNone(image.recognition_id)
+        self.assertEqual(self.run_worker(recognition.StubBackend()), 1)
+        image.refresh_from_db()
+        self.assertEqual(image.recognition.digest, name.split('.')[0])
+
+    def test_get_backend(self):
+        with mock.patch('api.recognition.RECOGNITION_CONFIG', {}), \
+                mock.patch('api.recognition.config.BAIDU_AIP', {'APP_ID': ''}, create=True):
+            self.assertIsNone(recognition.get_backend())
+            self.assertRaises(ValueError, recognition.Worker)
+            self.assertIsInstance(recognition.get_backend('stub'), recognition.StubBackend)
+            self.assertRaises(ValueError, recognition.get_backend, 'unknown')
+        with mock.patch('api.recognition.RECOGNITION_CONFIG', {'BACKEND': 'stub'}):
+            self.assertIsInstance(recognition.get_backend(), recognition.StubBackend)
+
+
+class ReferenceBatchTest(ApiTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.admin)
+        teacher = app_models.Teacher.objects.create(card_id='T001', name='赵老师')
+        rating = app_models.RatingInfo.objects.create(competition_name='蓝桥杯', category='A', level_title='国家级',
+                                                      level=1)
+        app_models.Competition.objects.create(name='第十届蓝桥杯', category='程序设计', organizer='组委会',
+                                              hold_time=datetime.date(2019, 5, 1), rating_info=rating)
+        self.record = create_record(self.student.user, '第十届蓝桥杯', main_student=self.student)
+        app_models.AwardRecord.objects.filter(id=self.record.id).update(teacher=teacher)
+        app_models.CompetitionRecord.objects.filter(award_record=self.record).update(competition='第十届蓝桥杯')
+        services.Summary.refresh([self.record.id])
+
+    def post(self, name, data):
+        res = self.client.post(reverse(name), data, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        return app_models.RecordSummary.objects.get(award_record=self.record)
+
+    def test_teacher(self):
+        version = app_models.RecordSummary.objects.get(award_record=self.record).version
+        # 没有变化的教师与新教师都不刷新记录
+        summary = self.post('api-admin-teacher-batch-list', [{'card_id': 'T001', 'name': '赵老师'},
+                                                             {'card_id': 'T002', 'name': '钱老师'}])
+        self.assertEqual(summary.version, version)
+        summary = self.post('api-admin-teacher-batch-list', [{'card_id': 'T001', 'name': '赵明'}])
+        self.assertGreater(summary.version, version)
+        self.assertEqual(summary.teacher_name, '赵明')
+
+    def test_rating_info(self):
+        version = app_models.RecordSummary.objects.get(award_record=self.record).version
+        summary = self.post('api-admin-rating-info-batch-list', [
+            {'competition_name': '蓝桥杯', 'category': 'A', 'level_title': '国家级', 'level': 1},
+            {'competition_name': '挑战杯', 'category': 'A', 'level_title': '国家级', 'level': 1}
+        ])
+        self.assertEqual(summary.version, version)
+        summary = self.post('api-admin-rating-info-batch-list', [
+            {'competition_name': '蓝桥杯', 'category': 'B', 'level_title': '省级', 'level': 2}
+        ])
+        self.assertGreater(summary.version, version)
+        self.assertEqual((summary.rating_category, summary.rating_level_title), ('B', '省级'))
+
+    def test_subject(self):
+        summary = self.post('api-admin-subject-batch-list', [{'name': '软件工程', 'college': '信息学院'}])
+        self.assertTrue(summary.main_student_location.startswith('信息学院 软件工程'))
@@ -14,6 +14,8 @@ router.register('student/classes', app_views.Student.Class, base_name='api-stude
 router.register('student/students', app_views.Student.Student, base_name='api-student-student')
 router.register('student/teachers', app_views.Student.Teacher, base_name='api-student-teacher')
 
+router.register('files/images', app_views.File.Image, base_name='api-file-image')
+
 router.register('admin/users', app_views.Admin.User, base_name='api-admin-user-list')
 router.register('admin/users', app_views.Admin.UserDetail, base_name='api-admin-user-detail')
 
@@ -26,12 +28,14 @@ router.register('admin/class-batch', app_views.Admin.ClassBatch, base_name='api-
 router.register('admin/students', app_views.Admin.Student, base_name='api-admin-student')
 router.register('admin/teachers', app_views.Admin.Teacher, base_name='api-admin-teacher')
 router.register('admin/student-batch', app_views.Admin.StudentBatch, base_name='api-admin-student-batch')
+router.register('admin/student-import', app_views.Admin.StudentImport, base_name='api-admin-student-import')
 router.register('admin/teacher-batch', app_views.Admin.TeacherBatch, base_name='api-admin-teacher-batch')
 
 router.register('admin/rating-info', app_views.Admin.RatingInfo, base_name='api-admin-rating-info')
 router.register('admin/rating-info-batch', app_views.Admin.RatingInfoBatch, base_name='api-admin-rating-info-batch')
 router.register('admin/competitions', app_views.Admin.Competition, base_name='api-admin-competition')
 router.register('admin/records', app_views.Admin.Record, base_name='api-admin-record')
+router.register('admin/export-jobs', app_views.Admin.ExportJob, base_name='api-admin-export-job')
 
 urlpatterns = []
 urlpatterns += router.urls
@@ -1,16 +1,17 @@
 from django.shortcuts import render
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.utils import timezone
 from django.contrib.auth import authenticate, login, logout
-from rest_framework import viewsets, response, status, exceptions, permissions, mixins
+from django.db import transaction
+from rest_framework import viewsets, response, status, exceptions, permissions, mixins, filters
+from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.decorators import action
 from rest_framework.authtoken.models import Token
 from . import exceptions as app_exceptions, serializers as app_serializers, models as app_models, permissions as app_permissions, services
-from . import enums, filters as app_filters
-from CertificateManager.settings import IMAGE_DIRS
+from . import enums, filters as app_filters, mixins as app_mixins, pagination as app_pagination, images as app_images
+from urllib.parse import quote
 import os
-import uuid
 
 
 class Auth:
@@ -28,7 +29,7 @@ class Auth:
             if user is not None:
                 login(request, user)
                 user.last_login = timezone.now()
-                user.save()
+                user.save(update_fields=('last_login',))
                 return response.Response(status=status.HTTP_200_OK)
             else:
                 raise exceptions.AuthenticationFailed()
@@ -55,7 +56,7 @@ class Auth:
             if user is not None:
                 token, created = Token.objects.get_or_create(user=user)
                 user.last_login = timezone.now()
-                user.save()
+                user.save(update_fields=('last_login',))
                 return response.Response({'token': token.key}, status=status.HTTP_200_OK)
             raise exceptions.AuthenticationFailed()
 
@@ -72,22 +73,34 @@ class Auth:
 
 
 class Student:
-    class Record(mixins.ListModelMixin, mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.UpdateModelMixin,
-                 viewsets.GenericViewSet):
+    class Record(app_mixins.QueryBudgetMixin, app_mixins.UpdateTimeConditionMixin, mixins.ListModelMixin,
+                 mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.UpdateModelMixin, viewsets.GenericViewSet):
         queryset = app_models.AwardRecord.objects
         serializer_class = app_serializers.Student.Record
         permission_classes = (app_permissions.IsStudent,)
         lookup_field = 'id'
         filterset_class = app_filters.Record
         ordering = '-update_time'
+        pagination_class = app_pagination.RecordPagination
+        query_budget = services.Query.RECORD_QUERY_BUDGET
+        # 审核、图片与关联数据的修改都会刷新RecordSummary.refresh_time与version
+        condition_time_fields = ('update_time', 'summary__refresh_time')
+        condition_version_field = 'summary__version'
 
         def get_queryset(self):
             user = self.request.user
-            return self.queryset.filter(submit_user=user).all()
+            return services.Query.records(self.queryset.filter(submit_user=user))
 
         def perform_create(self, serializer):
             serializer.validated_data['submit_user'] = self.request.user
-            super().perform_create(serializer)
+            with transaction.atomic():
+                super().perform_create(serializer)
+                services.Summary.refresh([serializer.instance.id])
+
+        def perform_update(self, serializer):
+            with transaction.atomic():
+                super().perform_update(serializer)
+                services.Summary.refresh([serializer.instance.id])
 
         def destroy(self, request, *args, **kwargs):
             instance = self.get_object()
@@ -112,37 +125,16 @@ class Student:
             award_record = request.POST.get('award_record')
             category = request.POST.get('category')
             file = request.FILES.get('file')
-            if not app_models.AwardRecord.objects.filter(id=award_record).exists():
+            if not app_models.AwardRecord.objects.filter(id=award_record, submit_user=request.user).exists():
                 return response.Response(status=404)
             if category != enums.ImageCategory.notice and category != enums.ImageCategory.award and \
                     category != enums.ImageCategory.list:
                 return response.Response(status=400)
+            if file is None:
+                return response.Response(status=400)
             name, ext = self.split_filename(file.name)
-            image = app_models.Image.objects.filter(award_record_id=award_record, category=category).first()
-            if image is None:
-                image = app_models.Image(award_record_id=award_record, category=category, file=None)
-            # 删除旧的文件
-            if image.file is not None:
-                old_path = '%s/%s' % (IMAGE_DIRS, image.file)
-                if os.path.exists(old_path):
-                    os.remove(old_path)
-                image.file = None
-            # 计算新文件名和新文件路径
-            new_image_name = '%s-%s-%s.%s' % (award_record, category, uuid.uuid4(), ext)
-            new_path = '%s/%s' % (IMAGE_DIRS, new_image_name)
-            # 将文件名保存下来
-            image.file = new_image_name
-            image.save()
-            # 存储路径不存在时先创建路径
-            if not os.path.exists(IMAGE_DIRS):
-                os.makedirs(IMAGE_DIRS)
-            # 该文件万一已经存在，就删除文件
-            if os.path.exists(new_path):
-                os.remove(new_path)
-            with open(new_path, 'wb') as f:
-                for c in file.chunks():
-                    f.write(c)
-            return response.Response({'award_record': award_record, 'category': category, 'file': new_image_name}, status=201)
+            image = services.ImageStore.save(award_record, category, file, ext)
+            return response.Response({'award_record': award_record, 'category': category, 'file': image.file}, status=201)
 
         @staticmethod
         def split_filename(filename):
@@ -152,80 +144,86 @@ class Student:
             else:
                 return filename, ''
 
-    class Class(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
-        queryset = app_models.Class.objects
+    class Class(app_mixins.VersionCacheMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin,
+                viewsets.GenericViewSet):
+        queryset = app_models.Class.objects.select_related('subject__college')
         serializer_class = app_serializers.Student.Class
         permission_classes = (app_permissions.IsStudent,)
+        cache_versions = ('class', 'subject', 'college')
         lookup_field = 'id'
         filter_fields = ('grade', 'number', 'subject__name', 'subject__college__name')
         search_fields = ('subject__name', 'grade', 'number')
         ordering_fields = ('grade', 'number', 'subject__name', 'subject__college__name')
 
-    class Student(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
-        queryset = app_models.Student.objects
+    class Student(app_mixins.VersionCacheMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin,
+                  viewsets.GenericViewSet):
+        queryset = app_models.Student.objects.select_related('clazz__subject__college')
         serializer_class = app_serializers.Student.Student
         permission_classes = (app_permissions.IsStudent,)
+        cache_versions = ('student', 'class', 'subject', 'college')
         lookup_field = 'card_id'
         filter_fields = ('card_id', 'name', 'clazz__grade', 'clazz__number', 'clazz__subject__name', 'clazz__subject__college__name')
         search_fields = ('card_id', 'name', 'clazz__subject__name', 'clazz__subject__college__name')
         ordering_fields = ('card_id', 'clazz__grade', 'clazz__number', 'clazz__subject__name', 'clazz__subject__college__name')
 
-    class Teacher(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    class Teacher(app_mixins.VersionCacheMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin,
+                  viewsets.GenericViewSet):
         queryset = app_models.Teacher.objects
         serializer_class = app_serializers.Student.Teacher
         permission_classes = (app_permissions.IsStudent,)
+        cache_versions = ('teacher',)
         lookup_field = 'card_id'
         filter_fields = ('card_id', 'name')
         search_fields = ('card_id', 'name')
         ordering_fields = ('card_id',)
 
 
+class File:
+    class Image(viewsets.ViewSet):
+        permission_classes = (app_permissions.IsLogin,)
+        lookup_field = 'file'
+        lookup_value_regex = '[^/]+'
+
+        def retrieve(self, request, file=None):
+            # 与Student.Image.get_queryset相同：学生只能获取自己提交的记录的图片，管理员可以获取全部图片
+            queryset = app_models.Image.objects.filter(file=file)
+            if not request.user.is_staff:
+                queryset = queryset.filter(award_record__submit_user=request.user)
+            path = services.ImageStore.get_path(file)
+            if not queryset.exists() or not os.path.exists(path):
+                raise exceptions.NotFound()
+            variant = request.query_params.get('variant', None)
+            if variant is not None:
+                if variant not in app_images.Derivative.VARIANTS:
+                    raise exceptions.ValidationError({'variant': 'Unknown variant %s.' % (variant,)})
+                # 派生图尚未生成时立即生成；原图无法处理时退回原图
+                if app_images.Derivative.ensure(file):
+                    path = app_images.Derivative.get_path(file, variant)
+            return services.Delivery.response(request, path)
+
+
 class Admin:
     class CollegeBatch(viewsets.ViewSet):
+        permission_classes = (app_permissions.IsStaff,)
+
         @staticmethod
         def create(request):
             data = request.data
-            result = []
-            for d in data:
-                serializer = app_serializers.Admin.College(data=d)
-                serializer.is_valid(raise_exception=True)
-                name = serializer.validated_data['name']
-                obj = app_models.College.objects.filter(name=name).first()
-                if obj is None:
-                    serializer.save()
-                    result.append(serializer.validated_data)
-                else:
-                    serializer.instance = obj
-                    result.append(serializer.validated_data)
+            result = services.Batch.batch_college(data)
             return response.Response(result, status=status.HTTP_201_CREATED)
 
     class SubjectBatch(viewsets.ViewSet):
+        permission_classes = (app_permissions.IsStaff,)
+
         @staticmethod
         def create(request):
             data = request.data
-            result = []
-            for d in data:
-                serializer = app_serializers.Admin.SubjectBatch(data=d)
-                serializer.is_valid(raise_exception=True)
-
-                name = serializer.validated_data['name']
-                college = serializer.validated_data['college']
-
-                college_obj = app_models.College.objects.filter(name=college).first()
-                if college_obj is None:
-                    college_obj = app_models.College(name=college)
-                    college_obj.save()
-                obj = app_models.Subject.objects.filter(name=name).first()
-                if obj is None:
-                    obj = app_models.Subject(name=name, college=college_obj)
-                    obj.save()
-                elif college_obj != obj.college:
-                    obj.college = college_obj
-                    obj.save()
-                result.append({'name': name, 'college': college})
+            result = services.Batch.batch_subject(data)
             return response.Response(result, status=status.HTTP_201_CREATED)
 
     class ClassBatch(viewsets.ViewSet):
+        permission_classes = (app_permissions.IsStaff,)
+
         @staticmethod
         def create(request):
             data = request.data
@@ -276,31 +274,32 @@ class Admin:
         ordering_fields = ('card_id',)
 
     class StudentBatch(viewsets.ViewSet):
+        permission_classes = (app_permissions.IsStaff,)
+
         @staticmethod
         def create(request):
             data = request.data
             result = services.Batch.batch_student(data)
             return response.Response(result, status=status.HTTP_201_CREATED)
 
+    class StudentImport(viewsets.ViewSet):
+        permission_classes = (app_permissions.IsStaff,)
+
+        @staticmethod
+        def create(request):
+            file = request.FILES.get('file')
+            if file is None:
+                raise app_exceptions.ApiError('FileRequired', 'Field file is required.')
+            result = services.Batch.import_student(file)
+            return response.Response(result, status=status.HTTP_201_CREATED)
+
     class TeacherBatch(viewsets.ViewSet):
+        permission_classes = (app_permissions.IsStaff,)
+
         @staticmethod
         def create(request):
             data = request.data
-            result = []
-            for d in data:
-                serializer = app_serializers.Admin.Teacher(data=d)
-                serializer.is_valid(raise_exception=True)
-                name = serializer.validated_data['name']
-                card_id = serializer.validated_data['card_id']
-                obj = app_models.Teacher.objects.filter(card_id=card_id).first()
-                if obj is None:
-                    serializer.save()
-                    result.append(serializer.validated_data)
-                else:
-                    serializer.instance = obj
-                    obj.name = name
-                    obj.save()
-                    result.append(serializer.validated_data)
+            result = services.Batch.batch_teacher(data)
             return response.Response(result, status=status.HTTP_201_CREATED)
 
     class RatingInfo(viewsets.ModelViewSet):
@@ -313,28 +312,12 @@ class Admin:
         ordering_fields = ('level', 'category')
 
     class RatingInfoBatch(viewsets.ViewSet):
+        permission_classes = (app_permissions.IsStaff,)
+
         @staticmethod
         def create(request):
             data = request.data
-            result = []
-            for d in data:
-                serializer = app_serializers.Admin.RatingInfo(data=d)
-                serializer.is_valid(raise_exception=True)
-                competition_name = serializer.validated_data['competition_name']
-                category = serializer.validated_data['category']
-                level_title = serializer.validated_data['level_title']
-                level = serializer.validated_data['level']
-                obj = app_models.RatingInfo.objects.filter(competition_name=competition_name).first()
-                if obj is None:
-                    serializer.save()
-                    result.append(serializer.validated_data)
-                else:
-                    serializer.instance = obj
-                    obj.category = category
-                    obj.level_title = level_title
-                    obj.level = level
-                    obj.save()
-                    result.append(serializer.validated_data)
+            result = services.Batch.batch_rating_info(data)
             return response.Response(result, status=status.HTTP_201_CREATED)
 
     class Competition(viewsets.ModelViewSet):
@@ -405,20 +388,97 @@ class Admin:
                 user.save()
             super().perform_update(serializer)
 
-    class Record(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.UpdateModelMixin, viewsets.GenericViewSet):
+    class Record(app_mixins.QueryBudgetMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin,
+                 mixins.UpdateModelMixin, viewsets.GenericViewSet):
         queryset = app_models.AwardRecord.objects
         serializer_class = app_serializers.Admin.Record
         permission_classes = (app_permissions.IsStaff,)
         lookup_field = 'id'
-        filterset_class = app_filters.Record
+        filter_backends = (DjangoFilterBackend, app_filters.RecordSearchFilter, filters.OrderingFilter)
         ordering = '-update_time'
-        search_fields = ('works_name', 'award_level', 'competition_record__name', 'teacher__name', 'students__name', 'main_student__name')
+        search_fields = app_filters.RECORD_SEARCH_FIELDS
+        pagination_class = app_pagination.RecordPagination
+        query_budget = services.Query.RECORD_QUERY_BUDGET
+        # 列表与打包下载从RecordSummary单表读取
+        summary_actions = ('list', 'download')
+
+        @property
+        def filterset_class(self):
+            if self.action in self.summary_actions:
+                return app_filters.RecordSummary
+            return app_filters.Record
+
+        def get_queryset(self):
+            if self.action in self.summary_actions:
+                return app_models.RecordSummary.objects.all()
+            return services.Query.records(self.queryset.all())
+
+        def get_serializer_class(self):
+            if self.action in self.summary_actions:
+                return app_serializers.Admin.RecordSummary
+            return super().get_serializer_class()
+
+        def perform_update(self, serializer):
+            with transaction.atomic():
+                super().perform_update(serializer)
+                services.Summary.refresh([serializer.instance.id])
 
         @action(methods=['GET'], detail=False)
         def download(self, request):
             queryset = self.filter_queryset(self.get_queryset())
-            serializer = self.get_serializer(queryset, many=True)
-            file = services.Download.generate_zip(serializer.data, uuid.uuid4())
-            res = FileResponse(open(file, 'rb'), as_attachment=True, filename='打包.zip')
-            os.remove(file)
+            params = app_filters.RecordSummary.get_params(request.query_params)
+            if 'watermark' in request.query_params:
+                # 增量导出：只包含水位之后修改过的记录，manifest.json中列出删除的记录与下一个水位
+                queryset, manifest = services.Delta.prepare(queryset, params, request.query_params['watermark'])
+                res = StreamingHttpResponse(services.Download.iter_zip(queryset, manifest),
+                                            content_type='application/zip')
+                res['X-Export-Watermark'] = manifest['watermark']
+            else:
+                key = services.ExportCache.get_key(queryset, params)
+                cached = services.ExportCache.open(key)
+                if cached is not None:
+                    return FileResponse(cached, as_attachment=True, filename='打包.zip')
+                res = StreamingHttpResponse(services.ExportCache.iter_zip(queryset, key), content_type='application/zip')
+            res['Content-Disposition'] = "attachment; filename*=utf-8''%s" % (quote('打包.zip'),)
             return res
+
+        @action(methods=['POST'], detail=False)
+        def review(self, request):
+            result = services.Batch.batch_review(request.data)
+            return response.Response(result, status=status.HTTP_200_OK)
+
+    class ExportJob(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+        queryset = app_models.ExportJob.objects
+        serializer_class = app_serializers.Admin.ExportJob
+        permission_classes = (app_permissions.IsStaff,)
+        lookup_field = 'id'
+        filter_fields = ('status',)
+        ordering = '-create_time'
+
+        def create(self, request):
+            params = request.data if len(request.data) > 0 else request.query_params
+            if not isinstance(params, dict):
+                raise app_exceptions.ApiError('InvalidParams', 'Parameters must be an object.')
+            job = services.Export.create_job(params, request.user, params.get('volumes', None),
+                                             params.get('partition', None))
+            serializer = self.get_serializer(job)
+            return response.Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+        @action(methods=['GET'], detail=True)
+        def download(self, request, id=None):
+            job = self.get_object()
+            if job.status != enums.ExportStatus.finished:
+                raise app_exceptions.ApiError('ExportNotFinished', 'Export job is %s.' % (job.status,),
+                                              status_code=status.HTTP_409_CONFLICT)
+            if job.volumes == 1:
+                return FileResponse(open(services.Export.get_path(job), 'rb'), as_attachment=True, filename='打包.zip')
+            # 分卷导出：不带volume参数时返回manifest.json，其中列出各分卷
+            volume = request.query_params.get('volume', None)
+            if volume is None:
+                return FileResponse(open(services.Export.get_manifest_path(job), 'rb'), as_attachment=True,
+                                    filename='manifest.json')
+            path = services.Export.get_volume_path(job, volume) if volume.isdigit() else None
+            if path is None or not os.path.exists(path):
+                raise app_exceptions.ApiError('VolumeNotFound', 'Volume %s does not exist.' % (volume,),
+                                              status_code=status.HTTP_404_NOT_FOUND)
+            return FileResponse(open(path, 'rb'), as_attachment=True, filename='打包-%s.zip' % (volume,))